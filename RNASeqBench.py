@@ -0,0 +1,290 @@
+# Import dependencies
+import argparse
+import contextlib
+import csv
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import openpyxl
+
+import RNASeqMatch
+
+# Define benchmark result file names
+json_result_filename='bench_results.json'
+csv_result_filename='bench_results.csv'
+
+# Define the startup probe, run in a fresh interpreter: prints the import time of RNASeqMatch and the lazily imported modules it loaded anyway
+startup_probe = ("import sys, time; start = time.perf_counter(); import RNASeqMatch; print(time.perf_counter() - start); "
+                 "print(' '.join(module for module in RNASeqMatch.lazy_modules if module in sys.modules))")
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser(description='Synthetic-data benchmark for RNASeqMatch.py: times ingest, lookup, match and export separately')
+    parser.add_argument('--files', type=int, default=20, help='number of Excel sheets to generate (default: %(default)s)')
+    parser.add_argument('--rows', type=int, default=5000, help='number of genes in every sheet (default: %(default)s)')
+    parser.add_argument('--xls', type=int, default=0, help='how many of the sheets are written as .xls instead of .xlsx, needs xlwt (default: %(default)s)')
+    parser.add_argument('--txt-files', type=int, default=2, help='number of TopX TXT files to generate (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=30, help='number of gene IDs listed under every comparison of a TXT file (default: %(default)s)')
+    parser.add_argument('--lookups', type=int, default=1000, help='number of single gene lookups in the lookup stage (default: %(default)s)')
+    parser.add_argument('--engine', choices=RNASeqMatch.engines, default=RNASeqMatch.engine, help='query engine (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes used to read Excel files (default: %(default)s)')
+    parser.add_argument('--format', choices=RNASeqMatch.output_formats, default=RNASeqMatch.output_format, help='output format of the match stage (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times every stage is run, the fastest run is reported (default: %(default)s)')
+    parser.add_argument('--startup-budget', type=float, default=0.5, help='seconds a fresh interpreter may take to import RNASeqMatch, the benchmark exits with 1 when it takes longer (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=2903, help='random seed of the synthetic data (default: %(default)s)')
+    parser.add_argument('--output-dir', default='.', help=f'directory {json_result_filename} and {csv_result_filename} are written to (default: %(default)s)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated data directory instead of deleting it')
+    return parser.parse_args()
+
+def synthetic_gene_ids(count: int, rng: random.Random) -> List[str]:
+
+    # Like the example data: one huge cluster with thousands of subclusters plus many single-transcript clusters
+    gene_ids = set()
+    while len(gene_ids) < count:
+        if rng.random() < 0.7:
+            gene_ids.add(f"Cluster-46176.{rng.randrange(count * 4)}")
+        else:
+            gene_ids.add(f"Cluster-{rng.randrange(1, 60000)}.0")
+    return sorted(gene_ids)
+
+def write_xlsx_sheet(file_path: str, gene_ids: List[str], rng: random.Random) -> None:
+
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Sheet1')
+    # GeneID in column A and log2FoldChange in column D, like the DESeq2 exports in Examples/input_data
+    worksheet.append(['GeneID', 'T_readcount', 'C_readcount', 'log2FoldChange', 'pval', 'padj'])
+    for gene_id in gene_ids:
+        worksheet.append([gene_id, rng.randrange(1000), rng.randrange(1000), rng.gauss(0, 4), rng.random(), rng.random()])
+    workbook.save(file_path)
+
+def write_xls_sheet(file_path: str, gene_ids: List[str], rng: random.Random) -> None:
+
+    import xlwt
+    workbook = xlwt.Workbook()
+    worksheet = workbook.add_sheet('Sheet1')
+    for column, title in enumerate(['GeneID', 'T_readcount', 'C_readcount', 'log2FoldChange', 'pval', 'padj']):
+        worksheet.write(0, column, title)
+    for row, gene_id in enumerate(gene_ids, start=1):
+        for column, value in enumerate([gene_id, rng.randrange(1000), rng.randrange(1000), rng.gauss(0, 4), rng.random(), rng.random()]):
+            worksheet.write(row, column, value)
+    workbook.save(file_path)
+
+def write_topx_file(file_path: str, comparisons: Dict[str, List[str]]) -> None:
+
+    # RTF-wrapped R print() output, the same layout as Examples/input_data/Top30_Log2FoldChange_*.txt
+    lines = ['{\\rtf1\\ansi\\ansicpg874\\cocoartf2580',
+             '\\cocoatextscaling0\\cocoaplatform0{\\fonttbl\\f0\\fswiss\\fcharset0 Helvetica;}',
+             '{\\colortbl;\\red255\\green255\\blue255;}',
+             '\\pard\\tx720\\tx1440\\pardirnatural\\partightenfactor0',
+             '',
+             '\\f0\\fs24 \\cf0 ']
+    for comparison, gene_ids in comparisons.items():
+        lines[-1] += f"{comparison}\\"
+        for start in range(0, len(gene_ids), 4):
+            quoted = ' '.join(f'"{gene_id}"' for gene_id in gene_ids[start:start + 4])
+            lines.append(f"{f'[{start + 1}]':>4} {quoted}\\")
+        lines.append('\\')
+        lines.append('')
+    lines.append('}')
+    with open(file_path, 'w') as file:
+        file.write('\n'.join(lines))
+
+def generate_inputs(input_directory: str, args) -> Tuple[List[str], List[str]]:
+
+    rng = random.Random(args.seed)
+    os.makedirs(input_directory, exist_ok=True)
+    comparisons = {}
+    gene_universe = synthetic_gene_ids(args.rows * 2, rng)
+    for file_index in range(1, args.files + 1):
+        comparison = f"T{file_index}vsC{file_index}"
+        gene_ids = rng.sample(gene_universe, args.rows)
+        if file_index <= args.xls:
+            write_xls_sheet(os.path.join(input_directory, f"{comparison}.xls"), gene_ids, rng)
+        else:
+            write_xlsx_sheet(os.path.join(input_directory, f"{comparison}.xlsx"), gene_ids, rng)
+        comparisons[comparison] = gene_ids
+
+    txt_paths = []
+    for txt_index in range(1, args.txt_files + 1):
+        topx = {comparison: ['C' + gene_id.split('-')[1] for gene_id in rng.sample(gene_ids, min(args.top, len(gene_ids)))] for comparison, gene_ids in comparisons.items()}
+        txt_path = os.path.join(input_directory, f"Top{args.top}_Log2FoldChange_bench{txt_index}.txt")
+        write_topx_file(txt_path, topx)
+        txt_paths.append(txt_path)
+    return [gene_id for gene_ids in comparisons.values() for gene_id in gene_ids], txt_paths
+
+def time_stage(results: List[dict], stage: str, function, rows: int, repeat: int = 1) -> int:
+
+    # The fastest of the repeated runs is reported, the application's own progress output is swallowed
+    best_wall = best_cpu = best_run = None
+    for run in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            function()
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        if best_wall is None or wall < best_wall:
+            best_wall, best_cpu, best_run = wall, cpu, run
+    results.append({'stage': stage, 'wall_seconds': round(best_wall, 6), 'cpu_seconds': round(best_cpu, 6), 'rows': rows,
+                    'rows_per_second': round(rows / best_wall, 1) if best_wall else None})
+    print(f"{stage:10} {best_wall:10.4f} s wall {best_cpu:10.4f} s cpu {rows:10} rows")
+    return best_run
+
+def time_startup(results: List[dict], budget: float, repeat: int) -> bool:
+
+    # Every run starts a new interpreter, otherwise the modules imported by this benchmark would already be loaded
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    best_wall = best_import = loaded_modules = None
+    for run in range(max(repeat, 3)):
+        wall_start = time.perf_counter()
+        probe = subprocess.run([sys.executable, '-c', startup_probe], cwd=script_directory, capture_output=True, text=True, check=True)
+        wall = time.perf_counter() - wall_start
+        if best_wall is None or wall < best_wall:
+            import_seconds, loaded_modules = (probe.stdout.splitlines() + [''])[:2]
+            best_wall, best_import = wall, float(import_seconds)
+    within_budget = best_import <= budget and not loaded_modules
+    results.append({'stage': 'startup', 'wall_seconds': round(best_wall, 6), 'cpu_seconds': None, 'rows': None, 'rows_per_second': None,
+                    'import_seconds': round(best_import, 6), 'budget_seconds': budget, 'eager_modules': loaded_modules.split(), 'within_budget': within_budget})
+    print(f"{'startup':10} {best_wall:10.4f} s wall {best_import:10.4f} s import (budget {budget} s){'' if within_budget else ' OVER BUDGET'}")
+    if loaded_modules:
+        print(f"{'':10} imported at startup although they should be loaded lazily: {loaded_modules}")
+    return within_budget
+
+def time_cli_lookup(results: List[dict], work_directory: str, cluster_prefix: str, repeat: int) -> None:
+
+    # A one-shot --lookup against a persistent store, the first run builds the store and is not timed.
+    # It runs in its own directory so that its clean-up does not delete the temporary database of this process
+    cli_directory = os.path.join(work_directory, 'cli')
+    os.makedirs(cli_directory, exist_ok=True)
+    command = [sys.executable, os.path.abspath(RNASeqMatch.__file__), '--persistent', '--engine', 'sqlite', '--input-dir', RNASeqMatch.input_directory, '--lookup', cluster_prefix]
+    subprocess.run(command, cwd=cli_directory, capture_output=True, check=True)
+    best_wall = None
+    for run in range(repeat):
+        wall_start = time.perf_counter()
+        subprocess.run(command, cwd=cli_directory, capture_output=True, check=True)
+        wall = time.perf_counter() - wall_start
+        best_wall = wall if best_wall is None else min(best_wall, wall)
+    results.append({'stage': 'cli_lookup', 'wall_seconds': round(best_wall, 6), 'cpu_seconds': None, 'rows': 1, 'rows_per_second': round(1 / best_wall, 1)})
+    print(f"{'cli_lookup':10} {best_wall:10.4f} s wall {cluster_prefix}")
+
+def git_commit() -> str:
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(args) -> dict:
+
+    work_directory = tempfile.mkdtemp(prefix='rnaseq_bench_')
+    RNASeqMatch.input_directory = os.path.join(work_directory, 'input_data')
+    RNASeqMatch.output_directory = os.path.join(work_directory, 'output_data')
+    RNASeqMatch.temp_directory = os.path.join(work_directory, 'temp')
+    RNASeqMatch.engine = args.engine
+    RNASeqMatch.ingest_workers = args.workers
+    RNASeqMatch.output_format = args.format
+    results = []
+    try:
+        within_budget = time_startup(results, args.startup_budget, args.repeat)
+        print(f"Generating {args.files} sheets x {args.rows} rows and {args.txt_files} TXT files in {work_directory}")
+        gene_ids, txt_paths = generate_inputs(RNASeqMatch.input_directory, args)
+
+        def ingest():
+            if args.engine == 'sqlite':
+                if RNASeqMatch.conn:
+                    RNASeqMatch.conn.close()
+                RNASeqMatch.setup_database()
+            RNASeqMatch.ingest_input_directory()
+        time_stage(results, 'ingest', ingest, args.files * args.rows, args.repeat)
+
+        rng = random.Random(args.seed)
+        lookup_ids = [rng.choice(gene_ids) for _ in range(args.lookups)]
+        def lookup():
+            # The query cache is disabled so that every lookup really reaches the engine
+            RNASeqMatch.configure_query_cache(0)
+            for gene_id in lookup_ids:
+                RNASeqMatch.search_gene_data(gene_id)
+        time_stage(results, 'lookup', lookup, args.lookups, args.repeat)
+        time_cli_lookup(results, work_directory, f"{gene_ids[0].split('-')[1].split('.')[0]}.*", args.repeat)
+
+        # The export is timed on its own by wrapping the exporter that match_txt_file() calls
+        export_seconds = []
+        export_output = RNASeqMatch.export_output
+        def timed_export_output(*export_args):
+            start = time.perf_counter()
+            export_output(*export_args)
+            export_seconds[-1] += time.perf_counter() - start
+        RNASeqMatch.export_output = timed_export_output
+        try:
+            match_rows = sum(1 for txt_path in txt_paths for comparison, gene_id in RNASeqMatch.iter_topx_file(txt_path) if gene_id)
+            def match():
+                export_seconds.append(0.0)
+                for txt_path in txt_paths:
+                    RNASeqMatch.match_txt_file(txt_path)
+            best_run = time_stage(results, 'match', match, match_rows, args.repeat)
+        finally:
+            RNASeqMatch.export_output = export_output
+        # Split the fastest match run into the matching itself and the export
+        export_wall = export_seconds[best_run]
+        results[-1]['wall_seconds'] = round(results[-1]['wall_seconds'] - export_wall, 6)
+        results[-1]['rows_per_second'] = round(match_rows / results[-1]['wall_seconds'], 1) if results[-1]['wall_seconds'] > 0 else None
+        results.append({'stage': 'export', 'wall_seconds': round(export_wall, 6), 'cpu_seconds': None, 'rows': match_rows,
+                        'rows_per_second': round(match_rows / export_wall, 1) if export_wall else None})
+        print(f"{'export':10} {export_wall:10.4f} s wall (included in match above)")
+    finally:
+        if RNASeqMatch.conn:
+            RNASeqMatch.conn.close()
+            RNASeqMatch.conn = None
+        if args.keep:
+            print(f"Generated data has been kept in {work_directory}")
+        else:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'parameters': {'files': args.files, 'rows': args.rows, 'xls': args.xls, 'txt_files': args.txt_files, 'top': args.top, 'lookups': args.lookups,
+                           'engine': args.engine, 'workers': args.workers, 'format': args.format, 'repeat': args.repeat, 'seed': args.seed,
+                           'startup_budget': args.startup_budget},
+            'within_startup_budget': within_budget, 'stages': results}
+
+def write_results(report: dict, output_directory: str) -> None:
+
+    os.makedirs(output_directory, exist_ok=True)
+    json_path = os.path.join(output_directory, json_result_filename)
+    with open(json_path, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    # One line per stage, appended so that runs of different commits can be compared side by side
+    csv_path = os.path.join(output_directory, csv_result_filename)
+    fields = ['timestamp', 'commit', 'engine', 'workers', 'format', 'files', 'rows', 'stage', 'wall_seconds', 'cpu_seconds', 'stage_rows', 'rows_per_second']
+    csv_exists = os.path.exists(csv_path)
+    with open(csv_path, 'a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fields)
+        if not csv_exists:
+            writer.writeheader()
+        for stage in report['stages']:
+            writer.writerow({'timestamp': report['timestamp'], 'commit': report['commit'], 'engine': report['parameters']['engine'], 'workers': report['parameters']['workers'],
+                             'format': report['parameters']['format'], 'files': report['parameters']['files'], 'rows': report['parameters']['rows'],
+                             'stage': stage['stage'], 'wall_seconds': stage['wall_seconds'], 'cpu_seconds': stage['cpu_seconds'], 'stage_rows': stage['rows'],
+                             'rows_per_second': stage['rows_per_second']})
+    print(f"Results have been written to {json_path} and {csv_path}")
+
+def main():
+    args = parse_arguments()
+    if args.xls and importlib.util.find_spec('xlwt') is None:
+        print("--xls needs xlwt to write .xls files, install it with: pip install xlwt")
+        sys.exit(1)
+    report = run_benchmark(args)
+    write_results(report, args.output_dir)
+    if not report['within_startup_budget']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,176 @@
 # Import dependencies
 import sqlite3
-import pandas as pd
+import numpy as np
 import os
-from typing import List, Tuple
-import natsort
+from typing import Dict, List, Tuple
 import re
 import time
 import shutil
 import signal
 import sys
+import argparse
+import hashlib
+import threading
+import queue
+import csv
+import importlib.util
+import glob
+import functools
+import pathlib
+import json
+import contextlib
+import cProfile
+import pstats
+import asyncio
+import tempfile
+import urllib.parse
+import urllib.request
+import urllib.error
+from http import HTTPStatus
+import io
+import mmap
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait as wait_futures, FIRST_COMPLETED
 
 # Define directory name
 input_directory='./input_data/'
 output_directory='./output_data/'
 temp_directory='./temp/'
+store_directory='./store/'
+cache_directory='./cache/'
 
 # Define file name
 database_name='gene_data.db'
-auto_match_output_filename='output.xlsx'
+
+# Define modules that are only imported by the functions needing them, so that a lookup does not pay for loading them at startup
+lazy_modules = ['openpyxl', 'xlrd', 'natsort']
+
+# Define snapshot option (the in-memory gene matrix is kept in one memory-mapped file that is opened instead of reading the Excel files again)
+snapshot_path = None
+snapshot_name = 'gene_data.snapshot'
+snapshot_magic = b'RNASNAP1'
+snapshot_version = 3
+# Sections of the snapshot start on page boundaries, so that every array maps onto whole pages
+snapshot_alignment = 4096
+
+# Define persistent store option (keeps the database between runs and only re-reads new or changed files)
+persistent_store = False
+schema_version = 4
+
+# Define bulk load option (all Excel files are loaded in one transaction and the gene key index is built once at the end)
+bulk_load = True
+
+# Define SQLite pragmas set on every connection that writes to the database, --sqlite-pragma NAME=VALUE overrides them.
+# The temporary database is thrown away after every run so it does not need to survive a crash, the persistent store does
+sqlite_pragmas = {'journal_mode': 'MEMORY', 'synchronous': 'OFF', 'cache_size': -262144, 'temp_store': 'MEMORY'}
+persistent_sqlite_pragmas = {'synchronous': 'NORMAL', 'cache_size': -262144, 'temp_store': 'MEMORY'}
+sqlite_pragma_pattern = re.compile(r'^([a-z_]+)=(-?\w+)$')
+
+# Define gene ID pattern, Cluster-46176.15267 is stored as the integer key (46176, 15267)
+gene_key_pattern = re.compile(r'(?:[C|c]luster-)?(\d+)\.(\d+)')
+# Define Excel sheet patterns, the gene ID and log2FoldChange columns are found by their header and the key is taken from the end of the gene ID
+sheet_gene_id_header = 'geneid'
+sheet_log2foldchange_header = 'log2foldchange'
+sheet_gene_id_pattern = re.compile(r'(\d+)\.(\d+)$')
+
+# Define cluster prefix pattern, 46176.* or Cluster-46176.* asks for every subcluster of cluster 46176
+cluster_prefix_pattern = re.compile(r'^\s*(?:[C|c](?:luster-)?)?(\d+)\.?\*\s*$')
+
+# Define TopX reference file patterns, RTF markup is removed before comparison headers (T1VsC1) and gene IDs (C46176.15267) are picked up
+rtf_markup_pattern = re.compile(r"\\'[0-9a-fA-F]{2}|\\[a-zA-Z]+-?\d* ?|\\.|[{}]", re.DOTALL)
+topx_token_pattern = re.compile(r'(?P<comparison>T\d+VsC\d+|T\d+vsC\d+|t\d+vsC\d+|T\d+vsc\d+|t\d+vs\d+)|(?P<gene_id>C\d+\.\d+)')
+
+# Define parse cache option (keeps every parsed sheet as a binary .npz file keyed by the content hash of its source file)
+use_parse_cache = False
+
+# Define number of worker processes used to parse Excel files (1 reads the files one by one)
+ingest_workers = 1
+
+# Define ingest pipeline options, a full queue between two stages pauses the stage in front of it so that memory use stays bounded
+pipeline_queue_size = 4
+pipeline_batch_rows = 50000
+
+# Define out-of-core option (--memory-budget in MiB, 0 means no budget). The data stays in the SQLite database on disk, and the page cache,
+# the ingest batches and the matching blocks are sized from the budget; the rest of it is left to the interpreter and the libraries
+memory_budget = 0
+memory_budget_shares = {'sqlite_cache': 0.25, 'ingest': 0.2, 'match': 0.2}
+# Rough sizes in bytes of one parsed row, and of one gene ID of a matching block per Excel file, as the Python objects holding them
+ingest_row_bytes = 160
+match_hit_bytes = 256
+# Define out-of-core global variables
+spill_count = 0
+database_spilling = False
+memory_budget_exceeded = False
+
+# Define number of rows written per record batch of parquet and feather output
+export_batch_rows = 65536
+
+# Define number of gene lookups kept in the query cache of search_gene_data() (0 disables the cache)
+query_cache_size = 256
+# Define query cache generation, bumped on every change to the data and part of every cache key, so a lookup that read the old data cannot be served afterwards
+data_generations = itertools.count()
+data_generation = next(data_generations)
+
+# Define number of TXT files matched at the same time in batch mode, each job reads the store through its own read-only connection
+match_jobs = 1
+
+# Define input watcher option, the input directory is polled every watch_interval seconds for new, changed or removed Excel files (0 disables the watcher)
+watch_interval = 0
+# Define number of seconds clean_up() waits for the input watcher to finish the file it is reading
+watcher_stop_timeout = 5
+
+# Define query server options, --serve answers lookups and matching jobs over HTTP, --connect sends them to a running server
+server_host = '127.0.0.1'
+server_port = 8765
+server_workers = 4
+
+# Define query engine, memory keeps a genes x files matrix in RAM instead of a SQLite database in temp_directory
+engines = ['sqlite', 'memory']
+engine = 'sqlite'
+
+# Define auto-matching output format, parquet and feather need pyarrow to be installed
+output_formats = ['xlsx', 'csv', 'tsv', 'parquet', 'feather']
+output_format = 'xlsx'
+output_format_descriptions = {'xlsx': 'an Excel (.xlsx) file', 'csv': 'a CSV (.csv) file', 'tsv': 'a tab-separated (.tsv) file', 'parquet': 'a Parquet (.parquet) file', 'feather': 'a Feather (.feather) file'}
+
+# Define profiling options, --profile records wall time, CPU time and row counts of every stage into profile_report_name in output_directory
+profile_stages = ['precheck', 'snapshot', 'read_file', 'insert', 'index', 'match_parse', 'match_lookup', 'match_pivot', 'export']
+profile_report_name = 'profile_report.json'
+profiling = False
+cprofile_stage = None
 
 # Define database gloval variables
 conn = None
 c = None
 
+# Define in-memory engine global variables
+gene_matrix = None
+matrix_files = []
+
+# Define read-only connection global variables, every thread other than the main thread queries the store through its own connection
+read_only_state = threading.local()
+read_only_connections = []
+read_only_lock = threading.Lock()
+
+# Define input watcher global variables
+watcher_thread = None
+watcher_stop = threading.Event()
+
+# Define clean-up global variable, clean_up() only runs once even if it is reached again while it is running
+cleaning_up = False
+
+# Define profiling global variables
+profile_records = []
+stage_profilers = {}
+profile_lock = threading.Lock()
+profile_start = time.time()
+
 def handler(signum, frame):
+    # Only unwinds to the finally of main(), which cleans up once. A second signal (timeout sends one to the child and
+    # one to its process group) must not start cleaning up again in the middle of it
+    if cleaning_up:
+        return
     print(f"Received signal {signum}, cleaning up...")
-    clean_up()
     sys.exit(0)
 
 signal.signal(signal.SIGTERM, handler)
@@ -43,33 +188,545 @@ def setup_database():
 
     global conn, c
     global database_path
-    database_path = os.path.join(temp_directory,  database_name)
-    if not os.path.exists(temp_directory):
-        os.makedirs(temp_directory)
+    database_directory = store_directory if persistent_store else temp_directory
+    database_path = os.path.join(database_directory,  database_name)
+    if not os.path.exists(database_directory):
+        os.makedirs(database_directory)
+    # A temporary database left behind by an interrupted run would otherwise get every row twice
+    if not persistent_store and os.path.exists(database_path):
+        os.remove(database_path)
+    database_exists = os.path.exists(database_path)
     conn = sqlite3.connect(database_path)
+    apply_sqlite_pragmas(conn)
     c = conn.cursor()
-    print(f"{database_name} has been created")
+
+    # Start over if the store was written by an incompatible version of this script
+    if database_exists and c.execute("PRAGMA user_version").fetchone()[0] != schema_version:
+        print(f"{database_name} was created by another version, rebuilding it")
+        c.execute("DROP TABLE IF EXISTS gene_info")
+        c.execute("DROP TABLE IF EXISTS source_files")
+        c.execute("DROP TABLE IF EXISTS files")
+        database_exists = False
+    c.execute(f"PRAGMA user_version = {schema_version}")
+
+    if database_exists:
+        print(f"{database_name} has been opened from {database_directory}")
+    else:
+        print(f"{database_name} has been created")
     # Create gene_info table if it doesn't exist
     c.execute('''CREATE TABLE IF NOT EXISTS gene_info
-                (gene_id text, file_name text, log2foldchange real)''')
+                (cluster integer, subcluster integer, file_id integer, log2foldchange real)''')
     
-    # Add an index on the gene_id column for improved query performance
-    c.execute("CREATE INDEX IF NOT EXISTS gene_id_index ON gene_info(gene_id)")
+    # In bulk load mode the index is only built after all files have been loaded
+    if not bulk_load:
+        create_gene_key_index()
+
+    # Every Excel file is stored once under its path relative to input_directory, with the comparison it holds, gene_info refers to it by file_id.
+    # Files of the same name may sit in different subdirectories, file_name is only used for display.
+    # Size, modification time and hash are filled in for the persistent store so that unchanged files can be skipped on the next run
+    c.execute('''CREATE TABLE IF NOT EXISTS files
+                (file_id integer PRIMARY KEY, source_path text UNIQUE, file_name text, comparison text, size integer, mtime real, sha256 text, row_count integer DEFAULT 0)''')
     conn.commit()
 
+def apply_sqlite_pragmas(target_conn: sqlite3.Connection) -> None:
+
+    sqlite_pragma_values = dict(persistent_sqlite_pragmas if persistent_store else sqlite_pragmas)
+    # In WAL mode queries never wait for the input watcher, it can replace a file while matching keeps running
+    if watch_interval:
+        sqlite_pragma_values['journal_mode'] = 'WAL'
+    for name, value in sqlite_pragma_values.items():
+        target_conn.execute(f"PRAGMA {name} = {value}")
+
+def create_gene_key_index() -> None:
+
+    # Add a composite index on the gene key for improved query performance, building it once over all rows is much cheaper than keeping it sorted during the inserts
+    with profile_stage('index') as record:
+        c.execute("CREATE INDEX IF NOT EXISTS gene_key_index ON gene_info(cluster, subcluster)")
+        if profiling:
+            record['rows'] = c.execute("SELECT COUNT(*) FROM gene_info").fetchone()[0]
+
+def configure_memory_budget() -> None:
+
+    global pipeline_batch_rows
+    budget_bytes = memory_budget * 1024 * 1024
+    # Sorts and temporary tables, e.g. while the gene key index is built, go to temporary files instead of memory
+    cache_kib = int(budget_bytes * memory_budget_shares['sqlite_cache'] / 1024)
+    for pragmas in (sqlite_pragmas, persistent_sqlite_pragmas):
+        pragmas.update({'cache_size': -cache_kib, 'temp_store': 'FILE'})
+    # Every queue slot, the batch being parsed, the batch the parser holds back until it knows whether it is the last one and the batch being written hold one batch each
+    pipeline_batch_rows = max(min(int(budget_bytes * memory_budget_shares['ingest'] / ingest_row_bytes / (pipeline_queue_size + 3)), pipeline_batch_rows), 1000)
+    print(f"Memory budget of {memory_budget} MiB: {cache_kib // 1024} MiB SQLite page cache, ingest batches of {pipeline_batch_rows} rows, sorts and temporary tables on disk")
+
+def resident_memory() -> Tuple[int, int]:
+
+    # Returns the current and the peak resident memory in bytes, the current one is only known where /proc is available
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS bytes
+        peak = peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        peak = 0
+    try:
+        with open('/proc/self/statm') as statm:
+            current = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        current = peak
+    return current, max(peak, current)
+
+def report_spill(message: str) -> None:
+
+    global spill_count
+    spill_count += 1
+    print(f"Out-of-core: {message}")
+
+def check_memory_budget(stage: str) -> None:
+
+    # Called between chunks, the first time the resident memory is over the budget is reported
+    global memory_budget_exceeded
+    if not memory_budget or memory_budget_exceeded:
+        return
+    current, peak = resident_memory()
+    if current > memory_budget * 1024 * 1024:
+        memory_budget_exceeded = True
+        print(f"Out-of-core: resident memory of {current / 1024 / 1024:.0f} MiB is over the {memory_budget} MiB budget while {stage}")
+
+def check_database_spill(target_conn: sqlite3.Connection) -> None:
+
+    # Once the database outgrows the page cache, SQLite writes pages out to the database file as the cache fills
+    global database_spilling
+    if not memory_budget or database_spilling:
+        return
+    page_count, page_size = target_conn.execute("PRAGMA page_count").fetchone()[0], target_conn.execute("PRAGMA page_size").fetchone()[0]
+    cache_bytes = memory_budget * 1024 * 1024 * memory_budget_shares['sqlite_cache']
+    if page_count * page_size > cache_bytes:
+        database_spilling = True
+        report_spill(f"the database ({page_count * page_size / 1024 / 1024:.1f} MiB) has outgrown the {cache_bytes / 1024 / 1024:.1f} MiB page cache, pages are spilling to {database_path}")
+
+def match_block_rows(comparison_count: int) -> int:
+
+    # Number of gene IDs matched at once under the memory budget, 0 without a budget. TXT files matched at the same time share the budget
+    if not memory_budget:
+        return 0
+    file_count = current_cursor().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    gene_bytes = max(file_count, 1) * match_hit_bytes + comparison_count * 64
+    return max(int(memory_budget * 1024 * 1024 * memory_budget_shares['match'] / match_jobs / gene_bytes), 100)
+
+class GeneMatrix:
+
+    # Dense genes x files matrix of log2FoldChange values with a bitmap of the cells that hold a value, one bit per file packed into bytes.
+    # The arrays are either built in memory or mapped from a snapshot file, nothing here needs them to be read in full
+    def __init__(self, gene_keys: np.ndarray, source_paths: List[str], file_names: List[str], values: np.ndarray, bitmap: np.ndarray, extra_cells: np.ndarray, extra_values: np.ndarray):
+
+        self.gene_keys = gene_keys
+        # Every column is one Excel file, identified by its source_path() since files of the same name may sit in different subdirectories
+        self.source_paths = source_paths
+        self.file_names = file_names
+        self.values = values
+        self.bitmap = bitmap
+        # A gene listed more than once in a file keeps its further distinct values here as (row, column) cells sorted by row,
+        # lookups list them like the SQLite engine does while matching only uses the value in the matrix
+        self.extra_cells = extra_cells
+        self.extra_values = extra_values
+        self.comparisons = [file_comparison(file_name) for file_name in file_names]
+        import natsort
+        # Columns in natural file name order, so that results come out sorted like the SQLite engine's, rows are found by a binary search on the sorted gene keys
+        self.column_order = np.array(natsort.natsorted(range(len(file_names)), key=lambda column: file_names[column]), dtype=np.int64)
+        # Files of the same name in different subdirectories share one column when matching, as the SQLite engine only tells them apart by name there
+        self.name_groups = [np.array(list(group), dtype=np.int64) for file_name, group in itertools.groupby(self.column_order.tolist(), key=lambda column: file_names[column])]
+        self.shared_names = len(self.name_groups) < len(file_names)
+
+    @staticmethod
+    def pack_key(cluster: int, subcluster: int) -> int:
+
+        return (cluster << 32) | subcluster
+
+    @classmethod
+    def from_files(cls, files: List[Tuple[str, str, List[Tuple[int, int, float]]]]) -> 'GeneMatrix':
+
+        # files holds the source path, the file name and the gene data of every column
+        file_names = [file_name for file_path, file_name, gene_data in files]
+        file_arrays = [np.array(gene_data, dtype=np.float64).reshape(-1, 3) for file_path, file_name, gene_data in files]
+        file_keys = [(array[:, 0].astype(np.int64) << 32) | array[:, 1].astype(np.int64) for array in file_arrays]
+        gene_keys, rows = np.unique(np.concatenate(file_keys) if file_keys else np.empty(0, dtype=np.int64), return_inverse=True)
+
+        values = np.full((len(gene_keys), len(file_names)), np.nan, dtype=np.float64)
+        present = np.zeros((len(gene_keys), len(file_names)), dtype=bool)
+        extra_cells, extra_values = [np.empty((0, 2), dtype=np.int64)], [np.empty(0, dtype=np.float64)]
+        offset = 0
+        for column, array in enumerate(file_arrays):
+            file_rows = rows[offset:offset + len(array)]
+            offset += len(array)
+            # A gene listed twice in the same file is matched with the value the SQLite engine matches first: a missing value, otherwise the smallest.
+            # lexsort is stable and sorts by its last key first
+            order = np.lexsort((array[:, 2], ~np.isnan(array[:, 2]), file_rows))
+            file_rows, file_values = file_rows[order], array[order, 2]
+            first = np.ones(len(file_rows), dtype=bool)
+            first[1:] = file_rows[1:] != file_rows[:-1]
+            values[file_rows[first], column] = file_values[first]
+            present[file_rows[first], column] = True
+            # The other distinct values of the gene are kept in ascending order, repeated values are listed once like SELECT DISTINCT does
+            extra = ~first
+            extra[1:] &= file_values[1:] != file_values[:-1]
+            extra &= ~np.isnan(file_values)
+            extra_cells.append(np.column_stack([file_rows[extra], np.full(np.count_nonzero(extra), column, dtype=np.int64)]))
+            extra_values.append(file_values[extra])
+        extra_cells, extra_values = np.concatenate(extra_cells), np.concatenate(extra_values)
+        order = np.argsort(extra_cells[:, 0], kind='stable')
+        return cls(gene_keys, [file_path for file_path, file_name, gene_data in files], file_names, values, np.packbits(present, axis=1), extra_cells[order], extra_values[order])
+
+    def find_rows(self, packed_keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+
+        # Returns the row of every key and whether the key is there at all
+        rows = np.searchsorted(self.gene_keys, packed_keys)
+        found = rows < len(self.gene_keys)
+        found[found] = self.gene_keys[rows[found]] == packed_keys[found]
+        return rows, found
+
+    def present_rows(self, rows) -> np.ndarray:
+
+        # Unpacks the bitmap of the given rows (an index array or a slice) into a rows x files boolean block
+        return np.unpackbits(self.bitmap[rows], axis=1, count=len(self.file_names)).view(bool)
+
+    def row_extras(self, row: int) -> Dict[int, List[float]]:
+
+        first, end = np.searchsorted(self.extra_cells[:, 0], [row, row + 1])
+        extras = {}
+        for column, value in zip(self.extra_cells[first:end, 1].tolist(), self.extra_values[first:end].tolist()):
+            extras.setdefault(column, []).append(value)
+        return extras
+
+    def cell_results(self, row: int, columns: List[int], values: List[float]) -> List[Tuple[str, float]]:
+
+        # Missing log2FoldChange values are reported as None, like NULL values coming out of SQLite
+        extras = self.row_extras(row) if len(self.extra_values) else {}
+        results = []
+        for column, value in zip(columns, values):
+            results.append((self.file_names[column], None if np.isnan(value) else value))
+            results.extend((self.file_names[column], extra_value) for extra_value in extras.get(column, []))
+        if self.shared_names:
+            # Files sharing a name are listed as one, with every distinct value once, like SELECT DISTINCT file_name, log2foldchange does
+            results = [(file_name, value) for file_name, group in itertools.groupby(results, key=lambda result: result[0])
+                       for value in sorted({value for group_file_name, value in group}, key=lambda value: (value is not None, value))]
+        return results
+
+    def row_results(self, row: int) -> List[Tuple[str, float]]:
+
+        columns = self.column_order[self.present_rows([row])[0, self.column_order]]
+        return self.cell_results(row, columns.tolist(), self.values[row, columns].tolist())
+
+    def lookup(self, cluster: int, subcluster: int) -> List[Tuple[str, float]]:
+
+        rows, found = self.find_rows(np.array([self.pack_key(cluster, subcluster)], dtype=np.int64))
+        return self.row_results(int(rows[0])) if found[0] else []
+
+    def lookup_many(self, gene_keys: List[Tuple[int, int]]) -> Dict[Tuple[int, int], List[Tuple[str, float]]]:
+
+        unique_keys = list(set(gene_keys))
+        rows, found = self.find_rows(np.array([self.pack_key(cluster, subcluster) for cluster, subcluster in unique_keys], dtype=np.int64))
+        found_keys = [key for key, key_found in zip(unique_keys, found.tolist()) if key_found]
+        rows = rows[found]
+        # Fetch the whole block of requested rows at once, in natural file name order
+        block_present = self.present_rows(rows)[:, self.column_order]
+        block_values = self.values[rows[:, None], self.column_order]
+        results = {}
+        for key, row, row_present, row_values in zip(found_keys, rows.tolist(), block_present, block_values):
+            columns = np.flatnonzero(row_present)
+            results[key] = self.cell_results(row, self.column_order[columns].tolist(), row_values[columns].tolist())
+        return results
+
+    def file_data(self, column: int) -> np.ndarray:
+
+        rows = np.flatnonzero(self.bitmap[:, column >> 3] & (0x80 >> (column & 7)))
+        # The extra values of genes listed more than once go along, so that a rebuilt matrix still holds them
+        extra_rows = self.extra_cells[self.extra_cells[:, 1] == column, 0]
+        gene_keys = self.gene_keys[np.concatenate([rows, extra_rows])]
+        return np.column_stack([gene_keys >> 32, gene_keys & 0xFFFFFFFF, np.concatenate([self.values[rows, column], self.extra_values[self.extra_cells[:, 1] == column]])])
+
+    def replace_file(self, file_path: str, file_name: str, gene_data: List[Tuple[int, int, float]] = None) -> 'GeneMatrix':
+
+        # A new matrix is built with the column of the file replaced, added or (without gene_data) removed, queries keep using the current one meanwhile
+        files = [(self.source_paths[column], self.file_names[column], self.file_data(column)) for column in range(len(self.file_names)) if self.source_paths[column] != file_path]
+        if gene_data is not None:
+            files.append((file_path, file_name, gene_data))
+        return GeneMatrix.from_files(files)
+
+    def group_values(self, rows: np.ndarray, present: np.ndarray, group: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+
+        # Returns whether any file of the name group holds each row, and the value the SQLite engine matches first: a missing value, otherwise the smallest.
+        # min() propagates NaN, files not holding a row take part as infinity
+        group_present = present[:, group]
+        group_values = np.where(group_present, self.values[rows[:, None], group], np.inf).min(axis=1)
+        return group_present.any(axis=1), group_values
+
+    def lookup_comparisons(self, gene_keys: List[Tuple[int, int]], comparisons: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+
+        rows, found = self.find_rows(np.array([self.pack_key(cluster, subcluster) for cluster, subcluster in gene_keys], dtype=np.int64))
+        positions = np.flatnonzero(found)
+        rows = rows[found]
+        present = self.present_rows(rows)
+
+        # Walk the files in natural order, the first file of a comparison holding a gene fills its cell
+        comparison_columns = {comparison: column for column, comparison in enumerate(comparisons)}
+        filled = np.zeros((len(rows), len(comparisons)), dtype=bool)
+        hit_positions, hit_columns, hit_values = [], [], []
+        for group in self.name_groups:
+            column = comparison_columns.get(self.comparisons[group[0]])
+            if column is None:
+                continue
+            group_present, group_values = self.group_values(rows, present, group)
+            hits = group_present & ~filled[:, column]
+            filled[hits, column] = True
+            hit_positions.append(positions[hits])
+            hit_columns.append(np.full(np.count_nonzero(hits), column, dtype=np.int64))
+            hit_values.append(group_values[hits])
+        if not hit_positions:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return np.concatenate(hit_positions), np.concatenate(hit_columns), np.concatenate(hit_values)
+
+    def lookup_cluster(self, cluster: int) -> Tuple[List[int], List[str], np.ndarray]:
+
+        # Gene keys are sorted, so all subclusters of a cluster are one contiguous slice of rows
+        first_row, end_row = np.searchsorted(self.gene_keys, [self.pack_key(cluster, 0), self.pack_key(cluster + 1, 0)])
+        subclusters = (self.gene_keys[first_row:end_row] & 0xFFFFFFFF).tolist()
+        # Only files holding at least one subcluster of the cluster become columns, files sharing a name become one column
+        rows = np.arange(first_row, end_row)
+        present = self.present_rows(slice(first_row, end_row))
+        groups = [group for group in self.name_groups if present[:, group].any()]
+        block = np.empty((len(rows), len(groups)), dtype=np.float64)
+        for block_column, group in enumerate(groups):
+            group_present, group_values = self.group_values(rows, present, group)
+            block[:, block_column] = np.where(group_present, group_values, np.nan)
+        return subclusters, [self.file_names[group[0]] for group in groups], block
+
+def read_only_cursor() -> sqlite3.Cursor:
+
+    # Opened lazily once per thread, SQLite connections cannot be shared between threads.
+    # In autocommit mode no transaction outlives a query, so every query sees the files the input watcher has loaded so far
+    if not hasattr(read_only_state, 'cursor'):
+        read_only_conn = sqlite3.connect(pathlib.Path(database_path).absolute().as_uri() + '?mode=ro', uri=True, check_same_thread=False, isolation_level=None)
+        with read_only_lock:
+            read_only_connections.append(read_only_conn)
+        read_only_state.cursor = read_only_conn.cursor()
+    return read_only_state.cursor
+
+def current_cursor() -> sqlite3.Cursor:
+
+    return c if threading.current_thread() is threading.main_thread() else read_only_cursor()
+
+def close_read_only_connections() -> None:
+
+    with read_only_lock:
+        for read_only_conn in read_only_connections:
+            read_only_conn.close()
+        read_only_connections.clear()
+
+def build_gene_matrix() -> None:
+
+    global gene_matrix, matrix_files
+    with profile_stage('index') as record:
+        gene_matrix = GeneMatrix.from_files(matrix_files)
+        record['rows'] = len(gene_matrix.gene_keys)
+    matrix_files = []
+    invalidate_query_cache()
+    print(f"In-memory gene matrix has been built with {len(gene_matrix.gene_keys)} genes x {len(gene_matrix.file_names)} files ({(gene_matrix.values.nbytes + gene_matrix.bitmap.nbytes) / 1024 / 1024:.1f} MiB)")
+
+def snapshot_offset(offset: int) -> int:
+
+    return -(-offset // snapshot_alignment) * snapshot_alignment
+
+def write_snapshot(matrix: GeneMatrix, file_stats: Dict[str, Tuple[str, int, float]]) -> None:
+
+    # Layout: magic, header length, JSON header with the file table and the section offsets, then the sorted gene keys,
+    # the genes x files values matrix, the validity bitmap and the extra values of duplicated genes, each starting on a page boundary
+    with profile_stage('snapshot', 'write') as record:
+        recorded_stats = {source_path(file_path): (size, mtime) for file_path, (file_name, size, mtime) in file_stats.items()}
+        files = [{'source_path': file_path, 'file_name': file_name, 'size': recorded_stats.get(file_path, (None, None))[0], 'mtime': recorded_stats.get(file_path, (None, None))[1]}
+                 for file_path, file_name in zip(matrix.source_paths, matrix.file_names)]
+        arrays = {'gene_keys': matrix.gene_keys, 'values': matrix.values, 'bitmap': matrix.bitmap, 'extra_cells': matrix.extra_cells, 'extra_values': matrix.extra_values}
+        sections = {}
+        offset = 0
+        for name, array in arrays.items():
+            sections[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+            offset = snapshot_offset(offset + array.nbytes)
+        header = json.dumps({'version': snapshot_version, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'files': files, 'sections': sections}).encode('utf-8')
+
+        # Written next to the snapshot and renamed over it, a crash leaves either the old or the new snapshot but never half of one
+        os.makedirs(os.path.dirname(os.path.abspath(snapshot_path)), exist_ok=True)
+        part_path = snapshot_path + '.part'
+        with open(part_path, 'wb') as snapshot_file:
+            snapshot_file.write(snapshot_magic + len(header).to_bytes(8, 'little') + header)
+            data_offset = snapshot_offset(snapshot_file.tell())
+            for name, array in arrays.items():
+                snapshot_file.seek(data_offset + sections[name]['offset'])
+                np.ascontiguousarray(array).tofile(snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(part_path, snapshot_path)
+        record['rows'] = len(matrix.gene_keys)
+    print(f"Snapshot of {len(matrix.gene_keys)} genes x {len(matrix.file_names)} files has been written to {snapshot_path} ({os.path.getsize(snapshot_path) / 1024 / 1024:.1f} MiB)")
+
+def open_snapshot() -> Tuple[GeneMatrix, Dict[str, Tuple[int, float]]]:
+
+    # Returns the matrix mapped from the snapshot and the size and modification time of every file it was built from
+    with profile_stage('snapshot', 'open') as record:
+        with open(snapshot_path, 'rb') as snapshot_file:
+            if snapshot_file.read(len(snapshot_magic)) != snapshot_magic:
+                raise ValueError("not a snapshot file")
+            header_length = int.from_bytes(snapshot_file.read(8), 'little')
+            header = json.loads(snapshot_file.read(header_length))
+            if header.get('version') != snapshot_version:
+                raise ValueError(f"snapshot version {header.get('version')} is not supported")
+            # The mapping outlives the file object, pages are only read from disk when a lookup touches them
+            snapshot_buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        data_offset = snapshot_offset(len(snapshot_magic) + 8 + header_length)
+        arrays = {}
+        for name, section in header['sections'].items():
+            dtype = np.dtype(section['dtype'])
+            count = int(np.prod(section['shape']))
+            if count == 0:
+                arrays[name] = np.empty(section['shape'], dtype=dtype)
+            else:
+                arrays[name] = np.frombuffer(snapshot_buffer, dtype=dtype, count=count, offset=data_offset + section['offset']).reshape(section['shape'])
+        matrix = GeneMatrix(arrays['gene_keys'], [file['source_path'] for file in header['files']], [file['file_name'] for file in header['files']],
+                            arrays['values'], arrays['bitmap'], arrays['extra_cells'], arrays['extra_values'])
+        record['rows'] = len(matrix.gene_keys)
+    return matrix, {file['source_path']: (file['size'], file['mtime']) for file in header['files']}
+
+def refresh_from_snapshot(excel_files: List[Tuple[str, str]], file_stats: Dict[str, Tuple[str, int, float]]) -> List[Tuple[str, str]]:
+
+    # Returns the Excel files that still have to be read, None when the snapshot is up to date and has become the gene matrix
+    global gene_matrix, matrix_files
+    if not os.path.exists(snapshot_path):
+        print(f"No snapshot found at {snapshot_path}, it will be written once the Excel files have been read")
+        return excel_files
+    try:
+        snapshot_matrix, recorded_stats = open_snapshot()
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Snapshot {snapshot_path} cannot be used ({str(e)}), reading every Excel file again")
+        return excel_files
+
+    # Only size and modification time are compared, nothing is hashed or read
+    changed_files = [(file_path, file_name) for file_path, file_name in excel_files if file_path in file_stats and recorded_stats.get(source_path(file_path)) != tuple(file_stats[file_path][1:])]
+    removed_paths = set(recorded_stats) - {source_path(file_path) for file_path, file_name in excel_files}
+    if not changed_files and not removed_paths:
+        gene_matrix = snapshot_matrix
+        invalidate_query_cache()
+        print(f"Snapshot {snapshot_path} has been opened with {len(gene_matrix.gene_keys)} genes x {len(gene_matrix.file_names)} files, no Excel file has changed")
+        return None
+
+    # The unchanged files are taken over from the snapshot, only the others are read again
+    changed_paths = {source_path(file_path) for file_path, file_name in changed_files} | removed_paths
+    matrix_files = [(file_path, file_name, snapshot_matrix.file_data(column)) for column, (file_path, file_name) in enumerate(zip(snapshot_matrix.source_paths, snapshot_matrix.file_names))
+                    if file_path not in changed_paths]
+    for file_path in sorted(removed_paths):
+        print(f"{file_path} is no longer in {input_directory}, removing it from the snapshot")
+    print(f"{len(changed_files)} Excel file(s) are new or have changed since the snapshot was written")
+    return changed_files
+
 def clean_up():
     
+    global cleaning_up
+    if cleaning_up:
+        return
+    cleaning_up = True
+    # Python puts the default handler back while shutting down, a late SIGTERM would kill the process halfway through exiting
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
     print_dynamic_line('Cleaning up...')
+    stop_input_watcher()
+    close_read_only_connections()
     if conn:
         conn.close()
         print('Disconnecting from the database')
 
+    if persistent_store:
+        print(f"Persistent store has been kept in {store_directory}")
+    if snapshot_path and os.path.exists(snapshot_path):
+        print(f"Snapshot has been kept in {snapshot_path}")
+
+    if memory_budget:
+        current, peak = resident_memory()
+        print(f"Peak resident memory was {peak / 1024 / 1024:.0f} MiB of the {memory_budget} MiB budget{' (over budget)' if peak > memory_budget * 1024 * 1024 else ''}, "
+              f"{spill_count} out-of-core spill(s) reported")
+
+    if profiling or cprofile_stage:
+        write_profile_report()
+
     if os.path.exists(temp_directory):
         # Delete the temporary directory
         shutil.rmtree(temp_directory, ignore_errors=True)     
         print("All temporary files has been deleted.")  
     print_dynamic_line('Done cleaning up')
 
+@contextlib.contextmanager
+def profile_stage(stage: str, detail: str = None):
+
+    # The caller fills in the row count of the yielded record, nothing is measured unless profiling is switched on
+    record = {'stage': stage, 'detail': detail, 'rows': None}
+    if not profiling and cprofile_stage != stage:
+        yield record
+        return
+    profiler = None
+    if cprofile_stage == stage:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can be active at a time on newer Python versions, e.g. when the stage runs in concurrent jobs
+            profiler = None
+    start_wall, start_cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield record
+    finally:
+        # CPU time is the time of the thread running the stage, work done in other threads or processes is not included
+        record['wall_seconds'] = time.perf_counter() - start_wall
+        record['cpu_seconds'] = time.thread_time() - start_cpu
+        if profiler:
+            profiler.disable()
+        add_profile_record(record, profiler)
+
+def add_profile_record(record: Dict, profiler: cProfile.Profile = None) -> None:
+
+    with profile_lock:
+        if profiling:
+            profile_records.append(record)
+        if profiler:
+            stage_profilers.setdefault(record['stage'], []).append(profiler)
+
+def write_profile_report() -> None:
+
+    os.makedirs(output_directory, exist_ok=True)
+    # Profiles of the same stage are merged into one .prof file that can be opened with pstats or snakeviz
+    for stage, profilers in stage_profilers.items():
+        profile_path = os.path.join(output_directory, f"{stage}.prof")
+        pstats.Stats(*profilers).dump_stats(profile_path)
+        print(f"cProfile output of the {stage} stage has been written to {profile_path}")
+    if not profiling:
+        return
+
+    stages = {}
+    for record in profile_records:
+        summary = stages.setdefault(record['stage'], {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'rows': 0})
+        summary['calls'] += 1
+        summary['wall_seconds'] += record['wall_seconds']
+        summary['cpu_seconds'] += record['cpu_seconds']
+        summary['rows'] += record['rows'] or 0
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(profile_start)),
+        'wall_seconds': time.time() - profile_start,
+        'engine': engine,
+        'ingest_workers': ingest_workers,
+        'match_jobs': match_jobs,
+        'output_format': output_format,
+        'stages': {stage: stages[stage] for stage in profile_stages if stage in stages},
+        'records': profile_records,
+    }
+    report_path = os.path.join(output_directory, profile_report_name)
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"Profile report has been written to {report_path}")
+
 def wait(waittime: int, animation: str = '/-\|') -> None:
     start_time = time.time()
     i = 0
@@ -112,52 +769,184 @@ def precheck_source() -> bool:
                     user_input = input("Do you want to continue without TXT file? This means that auto-matching feature will be diabled (y/n): ")
                     if user_input.lower() in ['yes', 'y']:
                         continue_with_automatch = False
-                        return continue_with_automatch
+                        break
                     elif user_input.lower() in ['no', 'n']:
                         print(f"Move or copy your TopX_Log2FoldChange_DATE.txt file into {input_directory} and try again later")
                         input("Press Enter to exit...")
                         raise SystemExit
                     else:
                         print("Invalid input...")            
-            else:
-                print(f'Adding excel file(s) in {input_directory} into database')
-                for subdir, dirs, file_names in os.walk(input_directory):
-                    excel_files = [file_name for file_name in file_names if file_name.endswith('.xlsx') or file_name.endswith('.xls')]
-                    print(f'Found {len(excel_files)} Excel file(s)')
-
-                    for file_name in excel_files:
-                        file_path = os.path.join(subdir, file_name)
-                        read_file(file_path, file_name)
-                        print(f"Added {file_name} into database")
+        ingest_input_directory()
     return continue_with_automatch
 
-def insert_gene_data(gene_id: str, file_name: str, log2foldchange: float) -> None:
+def ingest_input_directory() -> int:
 
-    c.execute("INSERT INTO gene_info VALUES (?, ?, ?)", (gene_id, file_name, log2foldchange))
+    print(f'Adding excel file(s) in {input_directory} into database')
+    with profile_stage('precheck') as record:
+        excel_files = find_excel_files()
+        print(f'Found {len(excel_files)} Excel file(s)')
+        excel_file_count = len(excel_files)
+
+        if persistent_store:
+            excel_files = changed_source_files(excel_files)
+            print(f'{len(excel_files)} Excel file(s) are new or have changed since the last run')
+        record['rows'] = excel_file_count
+
+    if engine == 'memory' and snapshot_path:
+        # Stat the files before they are read, a file changing while it is read is then picked up by the next run
+        file_stats = excel_file_stats(excel_files)
+        excel_files = refresh_from_snapshot(excel_files, file_stats)
+        if excel_files is None:
+            return excel_file_count
+
+    if engine == 'sqlite' and bulk_load:
+        conn.execute("BEGIN")
+    if excel_files:
+        ingest_pipeline(excel_files, ingest_workers)
+
+    if engine == 'memory':
+        build_gene_matrix()
+        if snapshot_path:
+            write_snapshot(gene_matrix, file_stats)
+    else:
+        conn.commit()
+        if bulk_load:
+            create_gene_key_index()
+            conn.commit()
+            check_database_spill(conn)
+    return excel_file_count
+
+def find_excel_files() -> List[Tuple[str, str]]:
+
+    excel_files = []
+    for subdir, dirs, file_names in os.walk(input_directory):
+        excel_files += [(os.path.join(subdir, file_name), file_name) for file_name in file_names if file_name.endswith('.xlsx') or file_name.endswith('.xls')]
+    return excel_files
+
+def file_hash(file_path: str) -> str:
+
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def changed_source_files(excel_files: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+
+    recorded = {row[0]: row[1:] for row in c.execute("SELECT source_path, size, mtime, sha256 FROM files")}
+    changed_files = []
+    for file_path, file_name in excel_files:
+        stat = os.stat(file_path)
+        if source_path(file_path) in recorded:
+            size, mtime, sha256 = recorded[source_path(file_path)]
+            # Same size and modification time, the file is trusted to be unchanged without hashing it
+            if size == stat.st_size and mtime == stat.st_mtime:
+                continue
+            # Touched but identical content, only refresh the recorded metadata
+            if size == stat.st_size and sha256 == file_hash(file_path):
+                c.execute("UPDATE files SET mtime=? WHERE source_path=?", (stat.st_mtime, source_path(file_path)))
+                continue
+            # Changed content, drop the old rows before the file is read again
+            remove_file(conn, file_path)
+        changed_files.append((file_path, file_name))
+
+    # Forget files that have been removed from the input directory
+    current_source_paths = {source_path(file_path) for file_path, file_name in excel_files}
+    for recorded_path in recorded:
+        if recorded_path not in current_source_paths:
+            print(f"{recorded_path} is no longer in {input_directory}, removing it from database")
+            remove_file(conn, os.path.join(input_directory, recorded_path))
     conn.commit()
+    invalidate_query_cache()
+    return changed_files
+
+def source_path(file_path: str) -> str:
+
+    # input_data/a/T1VsC1.xls and input_data/b/T1VsC1.xls are different files, they are told apart by their path below input_directory
+    return pathlib.Path(os.path.relpath(file_path, input_directory)).as_posix()
+
+def remove_file(target_conn: sqlite3.Connection, file_path: str) -> None:
+
+    target_conn.execute("DELETE FROM gene_info WHERE file_id IN (SELECT file_id FROM files WHERE source_path=?)", (source_path(file_path),))
+    target_conn.execute("DELETE FROM files WHERE source_path=?", (source_path(file_path),))
+    invalidate_query_cache()
+
+def record_source_file(target_conn: sqlite3.Connection, file_path: str) -> None:
+
+    stat = os.stat(file_path)
+    target_conn.execute("UPDATE files SET size=?, mtime=?, sha256=? WHERE source_path=?", (stat.st_size, stat.st_mtime, file_hash(file_path), source_path(file_path)))
+
+def gene_key(gene_id: str) -> Tuple[int, int]:
+
+    # The last number pattern in the text wins, e.g. cluster168324.0 and C168324.0 both give (168324, 0)
+    cluster, subcluster = gene_key_pattern.findall(gene_id)[-1]
+    return int(cluster), int(subcluster)
+
+def gene_key_text(cluster: int, subcluster: int) -> str:
+
+    return f"{cluster}.{subcluster}"
+
+def file_comparison(file_name: str) -> str:
+
+    # T15vsC15.xls holds the comparison T15vsC15, the label used in the TXT files
+    return os.path.splitext(file_name)[0].strip()
+
+def register_file(target_conn: sqlite3.Connection, file_path: str, file_name: str, row_count: int) -> int:
+
+    target_conn.execute("INSERT OR IGNORE INTO files (source_path, file_name, comparison) VALUES (?, ?, ?)", (source_path(file_path), file_name, file_comparison(file_name)))
+    target_conn.execute("UPDATE files SET row_count = row_count + ? WHERE source_path=?", (row_count, source_path(file_path)))
+    return target_conn.execute("SELECT file_id FROM files WHERE source_path=?", (source_path(file_path),)).fetchone()[0]
+
+def lookup_gene_key(cluster: int, subcluster: int, generation: int = 0) -> Tuple[Tuple[str, float], ...]:
+
+    # generation is only there to be part of the cache key
+    if engine == 'memory':
+        rows = gene_matrix.lookup(cluster, subcluster)
+    else:
+        cursor = current_cursor()
+        cursor.execute("SELECT DISTINCT file_name, log2foldchange FROM gene_info JOIN files USING (file_id) WHERE cluster=? AND subcluster=?", (cluster, subcluster))
+        rows = cursor.fetchall()
+
+    import natsort
+    rows_sorted = natsort.natsorted(rows, key=lambda row: (row[0], row[1]))
+    # A tuple, so that a cached result cannot be changed by the caller
+    return tuple((file_name, log2foldchange) for file_name, log2foldchange in rows_sorted)
+
+cached_lookup_gene_key = functools.lru_cache(maxsize=query_cache_size)(lookup_gene_key)
+
+def configure_query_cache(size: int) -> None:
+
+    global cached_lookup_gene_key
+    cached_lookup_gene_key = functools.lru_cache(maxsize=size)(lookup_gene_key)
+
+def invalidate_query_cache() -> None:
+
+    # Called whenever rows of gene_info are added or removed, and once more when the change has been committed or the matrix swapped.
+    # A lookup that started before the change stores its result under the previous generation, where no later lookup will find it
+    global data_generation
+    data_generation = next(data_generations)
+    cached_lookup_gene_key.cache_clear()
+
+def query_gene_key(cluster: int, subcluster: int) -> Tuple[Tuple[str, float], ...]:
+
+    return cached_lookup_gene_key(cluster, subcluster, data_generation)
+
+def print_query_cache_statistics() -> None:
+
+    cache_info = cached_lookup_gene_key.cache_info()
+    lookups = cache_info.hits + cache_info.misses
+    hit_rate = cache_info.hits / lookups * 100 if lookups else 0
+    print(f"Query cache: {cache_info.currsize} of {cache_info.maxsize} entries used, {cache_info.hits} hits, {cache_info.misses} misses ({hit_rate:.1f}% hit rate)")
 
 def search_gene_data(gene_id: str) -> List[Tuple[str, float]]:
     
     try:
-        gene_id_form = re.findall(r'(?:[C|c]luster-)?(\d+\.\d+)', gene_id)[-1]
+        cluster, subcluster = gene_key(gene_id)
+        gene_id_form = gene_key_text(cluster, subcluster)
 
         print(f"Gene ID being used to search database: {gene_id_form}")
-        c.execute("SELECT DISTINCT file_name, log2foldchange FROM gene_info WHERE gene_id=?", (gene_id_form,))
-        rows = c.fetchall()
-
-        rows_sorted = natsort.natsorted(rows, key=lambda row: (row[0], row[1]))
-        files_sorted = [row[0] for row in rows_sorted]
-        log2foldchanges_sorted = [row[1] for row in rows_sorted]
-        gene_data_list = list(zip(files_sorted, log2foldchanges_sorted))
-
-        # Print results
-        if gene_data_list:
-            print(f"Result(s) for Cluster-{gene_id_form}:")
-            for gene_data in gene_data_list:
-                print(f"File: {gene_data[0]:15} Log2FoldChange: {gene_data[1]}")
-        else:
-            print(f"No results found for Cluster-{gene_id_form}")
-
+        gene_data_list = list(query_gene_key(cluster, subcluster))
+        print_gene_data(gene_id_form, gene_data_list)
         return gene_data_list
 
     except Exception as e:
@@ -165,21 +954,638 @@ def search_gene_data(gene_id: str) -> List[Tuple[str, float]]:
         print(f"Error getting data for gene {gene_id}: {str(e)}")
         return None
 
-def read_file(file_path: str, file_name: str) -> List[Tuple[str, float]]:
-    
-    print(f"Reading {file_name}")
-    gene_data = []
+def print_gene_data(gene_id_form: str, gene_data_list: List[Tuple[str, float]]) -> None:
+
+    if gene_data_list:
+        print(f"Result(s) for Cluster-{gene_id_form}:")
+        for gene_data in gene_data_list:
+            print(f"File: {gene_data[0]:15} Log2FoldChange: {gene_data[1]}")
+    else:
+        print(f"No results found for Cluster-{gene_id_form}")
+
+def parse_file(file_path: str, use_cache: bool = False, content: bytes = None) -> List[Tuple[int, int, float]]:
+
+    # content holds the file when it has already been read into memory by the ingest pipeline
+    return [row for batch in iter_gene_data_batches(file_path, use_cache, content) for row in batch]
+
+def iter_gene_data_batches(file_path: str, use_cache: bool = False, content: bytes = None, batch_rows: int = None):
+
+    batch_rows = batch_rows or pipeline_batch_rows
+    if use_cache:
+        sha256 = file_hash(file_path) if content is None else hashlib.sha256(content).hexdigest()
+        gene_data = load_cached_sheet(sha256)
+        if gene_data is not None:
+            for batch_start in range(0, len(gene_data), batch_rows):
+                yield gene_data[batch_start:batch_start + batch_rows]
+            return
+
+    # Only a cache entry that is about to be written needs the whole sheet in memory
+    cached_gene_data = [] if use_cache else None
+    for batch in iter_excel_batches(file_path, content, batch_rows):
+        if cached_gene_data is not None:
+            cached_gene_data.extend(batch)
+        yield batch
+
+    if use_cache:
+        save_cached_sheet(sha256, cached_gene_data)
+
+def iter_excel_batches(file_path: str, content: bytes, batch_rows: int):
+
+    # Streams the gene ID and log2FoldChange columns of the first sheet as (cluster, subcluster, log2foldchange) batches, without building a DataFrame
+    if content is None:
+        with open(file_path, 'rb') as excel_file:
+            signature = excel_file.read(4)
+    else:
+        signature = content[:4]
+
+    # .xlsx files are zip archives, anything else is handed to xlrd as an .xls workbook
+    if signature.startswith(b'PK'):
+        import openpyxl
+        workbook = openpyxl.load_workbook(file_path if content is None else io.BytesIO(content), read_only=True, data_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            header = next(sheet.iter_rows(max_row=1, values_only=True), ())
+            gene_id_column, log2foldchange_column = sheet_columns(header, file_path)
+            first_column = min(gene_id_column, log2foldchange_column)
+            # Read-only worksheets parse one row at a time, only the cells between the two columns are materialized
+            rows = sheet.iter_rows(min_row=2, min_col=first_column + 1, max_col=max(gene_id_column, log2foldchange_column) + 1, values_only=True)
+            yield from gene_data_batches(((row[gene_id_column - first_column], row[log2foldchange_column - first_column]) for row in rows), batch_rows)
+        finally:
+            workbook.close()
+    else:
+        import xlrd
+        workbook = xlrd.open_workbook(file_path if content is None else None, file_contents=content, on_demand=True)
+        try:
+            sheet = workbook.sheet_by_index(0)
+            gene_id_column, log2foldchange_column = sheet_columns(sheet.row_values(0) if sheet.nrows else [], file_path)
+            yield from gene_data_batches(zip(sheet.col_values(gene_id_column, start_rowx=1), sheet.col_values(log2foldchange_column, start_rowx=1)), batch_rows)
+        finally:
+            workbook.release_resources()
+
+def sheet_columns(header, file_path: str) -> Tuple[int, int]:
+
+    header_names = ['' if name is None else str(name).strip().lower() for name in header]
+    if sheet_gene_id_header not in header_names or sheet_log2foldchange_header not in header_names:
+        raise ValueError(f"{os.path.basename(file_path)} has no GeneID and log2FoldChange columns in its first row")
+    return header_names.index(sheet_gene_id_header), header_names.index(sheet_log2foldchange_header)
+
+def gene_data_batches(cells, batch_rows: int):
+
+    batch = []
+    for gene_id, log2foldchange in cells:
+        # Rows without a valid gene ID are left out, missing or non-numeric values are kept as NaN
+        match = sheet_gene_id_pattern.search(str(gene_id))
+        if not match:
+            continue
+        try:
+            log2foldchange = float(log2foldchange)
+        except (TypeError, ValueError):
+            log2foldchange = float('nan')
+        batch.append((int(match.group(1)), int(match.group(2)), log2foldchange))
+        if len(batch) == batch_rows:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def cached_sheet_path(sha256: str) -> str:
+
+    return os.path.join(cache_directory, f"{sha256}.npz")
+
+def load_cached_sheet(sha256: str) -> List[Tuple[int, int, float]]:
+
+    cache_path = cached_sheet_path(sha256)
+    if not os.path.exists(cache_path):
+        return None
     try:
-        df = pd.read_excel(file_path, usecols="A,D")
-        gene_data = [(gene_id, log2foldchange) for gene_id, log2foldchange in zip(df["GeneID"], df["log2FoldChange"])]
-        gene_data = [(gene_id.split('-')[1], log2foldchange) for gene_id, log2foldchange in gene_data]
-        c.executemany("INSERT INTO gene_info VALUES (?, ?, ?)", [(gene_id, file_name, log2foldchange) for gene_id, log2foldchange in gene_data])
-        conn.commit()
-    except FileNotFoundError:
-        print(f"File {file_name} not found.")
+        with np.load(cache_path) as cached_sheet:
+            # Entries written before gene IDs were stored as integer keys are parsed again
+            if 'cluster' not in cached_sheet.files:
+                return None
+            return list(zip(cached_sheet['cluster'].tolist(), cached_sheet['subcluster'].tolist(), cached_sheet['log2foldchange'].tolist()))
     except Exception as e:
-        print(f"Error reading file {file_name}: {str(e)}")
-    return gene_data
+        print(f"Ignoring unreadable cache entry {cache_path}: {str(e)}")
+        return None
+
+def save_cached_sheet(sha256: str, gene_data: List[Tuple[int, int, float]]) -> None:
+
+    if not os.path.exists(cache_directory):
+        os.makedirs(cache_directory, exist_ok=True)
+    clusters = np.array([row[0] for row in gene_data], dtype=np.int64)
+    subclusters = np.array([row[1] for row in gene_data], dtype=np.int64)
+    log2foldchanges = np.array([row[2] for row in gene_data], dtype=np.float64)
+    # Write next to the final name and rename, so that a parallel reader never sees half a file
+    cache_path = cached_sheet_path(sha256)
+    partial_path = f"{cache_path}.{os.getpid()}.part"
+    with open(partial_path, 'wb') as file:
+        np.savez(file, cluster=clusters, subcluster=subclusters, log2foldchange=log2foldchanges)
+    os.replace(partial_path, cache_path)
+
+def prune_parse_cache() -> None:
+
+    if not os.path.exists(cache_directory):
+        print(f"{cache_directory} does not exist, nothing to prune")
+        return
+    current_hashes = set()
+    if os.path.exists(input_directory):
+        current_hashes.update(file_hash(file_path) for file_path, file_name in find_excel_files())
+
+    pruned_entries = 0
+    pruned_bytes = 0
+    for entry in os.scandir(cache_directory):
+        sha256 = entry.name.split('.')[0]
+        if sha256 not in current_hashes:
+            pruned_bytes += entry.stat().st_size
+            os.remove(entry.path)
+            pruned_entries += 1
+    print(f"Pruned {pruned_entries} stale cache entries ({pruned_bytes / 1024 / 1024:.1f} MiB) from {cache_directory}")
+
+def search_cluster_block(cluster: int, cursor: sqlite3.Cursor = None) -> Tuple[List[int], List[str], np.ndarray]:
+
+    # Returns the sorted subclusters, the file names in natural order and a subclusters x files block of values (NaN where missing)
+    if engine == 'memory':
+        return gene_matrix.lookup_cluster(cluster)
+
+    # Equality on the leading column of the composite index makes this one index range scan. Within a subcluster the rows are ordered
+    # like the match path picks them, NULL (sorted first by SQLite) before the smallest value
+    cursor = cursor or current_cursor()
+    cursor.execute("SELECT DISTINCT subcluster, file_name, log2foldchange FROM gene_info JOIN files USING (file_id) WHERE cluster=? ORDER BY subcluster, log2foldchange", (cluster,))
+    rows = cursor.fetchall()
+    import natsort
+    subclusters = sorted({row[0] for row in rows})
+    file_names = natsort.natsorted({row[1] for row in rows})
+    row_positions = {subcluster: row_index for row_index, subcluster in enumerate(subclusters)}
+    column_positions = {file_name: column_index for column_index, file_name in enumerate(file_names)}
+    block = np.full((len(subclusters), len(file_names)), np.nan, dtype=np.float64)
+    # Rows are scattered in reverse, so that the value a gene listed twice in the same file is matched with ends up in the block
+    for subcluster, file_name, log2foldchange in reversed(rows):
+        block[row_positions[subcluster], column_positions[file_name]] = np.nan if log2foldchange is None else log2foldchange
+    return subclusters, file_names, block
+
+def search_cluster_data(cluster_prefix: str) -> Tuple[List[int], List[str], np.ndarray]:
+
+    cluster = int(cluster_prefix_pattern.match(cluster_prefix).group(1))
+    print(f"Cluster being used to search database: {cluster}")
+    subclusters, file_names, block = search_cluster_block(cluster)
+    print_cluster_data(cluster, subclusters, file_names, block)
+    return subclusters, file_names, block
+
+def print_cluster_data(cluster: int, subclusters: List[int], file_names: List[str], block: np.ndarray) -> None:
+
+    if not subclusters:
+        print(f"No results found for Cluster-{cluster}.*")
+        return
+
+    print(f"Result(s) for Cluster-{cluster}.* ({len(subclusters)} subclusters):")
+    print(f"{'Gene ID':20}" + ''.join(f"{file_name:20}" for file_name in file_names))
+    for subcluster, values in zip(subclusters, block.tolist()):
+        print(f"{'Cluster-' + gene_key_text(cluster, subcluster):20}" + ''.join(f"{'' if np.isnan(value) else value:<20}" for value in values))
+
+@contextlib.contextmanager
+def temp_table_transaction(cursor: sqlite3.Cursor, tables: List[str]):
+
+    # Writing to a temporary table opens a transaction, and as long as it is open the connection keeps reading the
+    # snapshot it started with and never sees files loaded later by the input watcher. The tables are emptied first,
+    # so that rows left behind by a failed match cannot collide with the next one
+    for table in tables:
+        cursor.execute(f"DELETE FROM {table}")
+    try:
+        yield cursor
+    except BaseException:
+        cursor.connection.rollback()
+        raise
+    for table in tables:
+        cursor.execute(f"DELETE FROM {table}")
+    cursor.connection.commit()
+
+def search_gene_data_bulk(gene_ids: List[str], cursor: sqlite3.Cursor = None) -> Dict[str, List[Tuple[str, float]]]:
+
+    # Resolve every gene ID to the key stored in the database, IDs without a number pattern are left out
+    gene_id_forms = {}
+    for gene_id in gene_ids:
+        try:
+            gene_id_forms[gene_id] = gene_key(gene_id)
+        except IndexError:
+            print(f"Error getting data for gene {gene_id}: no gene ID found")
+
+    if engine == 'memory':
+        gene_data_by_form = gene_matrix.lookup_many(list(gene_id_forms.values()))
+        print(f"Result(s) found for {sum(1 for gene_id_form in gene_id_forms.values() if gene_id_form in gene_data_by_form)} of {len(gene_id_forms)} gene ID(s)")
+        return {gene_id: gene_data_by_form.get(gene_id_form, []) for gene_id, gene_id_form in gene_id_forms.items()}
+
+    # Load the whole set into a temporary table and fetch all hits with a single join,
+    # temporary tables belong to their connection so concurrent matches on other connections do not collide
+    cursor = cursor or current_cursor()
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS match_ids (cluster integer, subcluster integer, PRIMARY KEY (cluster, subcluster))")
+    with temp_table_transaction(cursor, ['match_ids']):
+        cursor.executemany("INSERT OR IGNORE INTO match_ids VALUES (?, ?)", gene_id_forms.values())
+        cursor.execute('''SELECT DISTINCT gene_info.cluster, gene_info.subcluster, files.file_name, gene_info.log2foldchange
+                    FROM match_ids JOIN gene_info ON gene_info.cluster = match_ids.cluster AND gene_info.subcluster = match_ids.subcluster
+                    JOIN files ON files.file_id = gene_info.file_id''')
+        rows = cursor.fetchall()
+
+    # Sorting once before grouping keeps every gene's hits in the same order as search_gene_data(),
+    # the natural order of the file names is worked out once per distinct file rather than once per row
+    import natsort
+    file_ranks = {file_name: rank for rank, file_name in enumerate(natsort.natsorted({row[2] for row in rows}))}
+    rows_sorted = sorted(rows, key=lambda row: (file_ranks[row[2]], row[3] is not None, row[3]))
+    gene_data_by_form = {}
+    for cluster, subcluster, file_name, log2foldchange in rows_sorted:
+        gene_data_by_form.setdefault((cluster, subcluster), []).append((file_name, log2foldchange))
+
+    print(f"Result(s) found for {sum(1 for gene_id_form in gene_id_forms.values() if gene_id_form in gene_data_by_form)} of {len(gene_id_forms)} gene ID(s)")
+    return {gene_id: gene_data_by_form.get(gene_id_form, []) for gene_id, gene_id_form in gene_id_forms.items()}
+
+def search_comparison_hits(gene_ids: List[str], comparisons: List[str], cursor: sqlite3.Cursor = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+
+    # Returns the position in gene_ids, the position in comparisons and the value of the first hit of every gene in every comparison
+    gene_id_forms = []
+    for position, gene_id in enumerate(gene_ids):
+        try:
+            gene_id_forms.append((position, gene_key(gene_id)))
+        except IndexError:
+            print(f"Error getting data for gene {gene_id}: no gene ID found")
+
+    if engine == 'memory':
+        form_positions, columns, values = gene_matrix.lookup_comparisons([gene_id_form for position, gene_id_form in gene_id_forms], comparisons)
+        positions = np.array([position for position, gene_id_form in gene_id_forms], dtype=np.int64)[form_positions]
+    else:
+        import natsort
+        # Files are resolved to their comparison column once, the join itself only compares integers
+        cursor = cursor or current_cursor()
+        comparison_columns = {comparison: column for column, comparison in enumerate(comparisons)}
+        match_files = [(file_id, file_name, comparison_columns[comparison]) for file_id, file_name, comparison in cursor.execute("SELECT file_id, file_name, comparison FROM files") if comparison in comparison_columns]
+        file_ranks = {file_name: rank for rank, file_name in enumerate(natsort.natsorted(file_name for file_id, file_name, column in match_files))}
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS match_files (file_id integer PRIMARY KEY, comparison_column integer, file_rank integer)")
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS match_genes (position integer, cluster integer, subcluster integer, PRIMARY KEY (cluster, subcluster, position))")
+        with temp_table_transaction(cursor, ['match_files', 'match_genes']):
+            cursor.executemany("INSERT INTO match_files VALUES (?, ?, ?)", [(file_id, column, file_ranks[file_name]) for file_id, file_name, column in match_files])
+            cursor.executemany("INSERT INTO match_genes VALUES (?, ?, ?)", [(position, cluster, subcluster) for position, (cluster, subcluster) in gene_id_forms])
+            cursor.execute('''SELECT match_genes.position, match_files.comparison_column, match_files.file_rank, gene_info.log2foldchange
+                        FROM match_genes JOIN gene_info ON gene_info.cluster = match_genes.cluster AND gene_info.subcluster = match_genes.subcluster
+                        JOIN match_files ON match_files.file_id = gene_info.file_id''')
+            hits = cursor.fetchall()
+        hit_keys = np.array([hit[:3] for hit in hits], dtype=np.int64).reshape(-1, 3)
+        hit_values = np.array([np.nan if hit[3] is None else hit[3] for hit in hits], dtype=np.float64)
+        del hits
+
+        # Files in natural order and missing values first like search_gene_data(), only the first hit of a gene in a comparison is kept.
+        # lexsort is stable and sorts by its last key first
+        order = np.lexsort((hit_values, ~np.isnan(hit_values), hit_keys[:, 2]))
+        unique_cells, first_hits = np.unique(hit_keys[order, 0] * max(len(comparisons), 1) + hit_keys[order, 1], return_index=True)
+        first_hits = order[first_hits]
+        positions = hit_keys[first_hits, 0]
+        columns = hit_keys[first_hits, 1]
+        values = hit_values[first_hits]
+
+    return positions, columns, values
+
+def add_gene_data(target_conn: sqlite3.Connection, file_path: str, file_name: str, gene_data: List[Tuple[int, int, float]]) -> None:
+
+    with profile_stage('insert', file_name) as record:
+        record['rows'] = len(gene_data)
+        if engine == 'memory':
+            # Files are collected first and turned into one matrix by build_gene_matrix()
+            matrix_files.append((source_path(file_path), file_name, gene_data))
+        else:
+            # Every file is a savepoint, a failing file only rolls back its own rows even inside the single transaction of a bulk load
+            target_conn.execute("SAVEPOINT add_gene_data")
+            try:
+                file_id = register_file(target_conn, file_path, file_name, len(gene_data))
+                target_conn.executemany("INSERT INTO gene_info VALUES (?, ?, ?, ?)", [(cluster, subcluster, file_id, log2foldchange) for cluster, subcluster, log2foldchange in gene_data])
+            except Exception:
+                target_conn.execute("ROLLBACK TO add_gene_data")
+                raise
+            finally:
+                target_conn.execute("RELEASE add_gene_data")
+            invalidate_query_cache()
+
+def timed_parse_file(file_path: str, use_cache: bool = False, content: bytes = None) -> Tuple[List[Tuple[int, int, float]], float, float]:
+
+    # Runs in a worker process, the timings are sent back with the parsed rows and recorded by the main process
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    gene_data = parse_file(file_path, use_cache, content)
+    return gene_data, time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+class PipelineStage:
+
+    # Work done by one stage of the ingest pipeline, the time spent waiting on the queues around it is kept apart from the time spent working
+    def __init__(self, name: str, parallelism: int = 1):
+
+        self.name = name
+        self.parallelism = parallelism
+        self.files = 0
+        self.rows = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0
+        self.input_wait_seconds = 0.0
+        self.output_wait_seconds = 0.0
+
+    def get(self, source_queue: queue.Queue):
+
+        start = time.perf_counter()
+        item = source_queue.get()
+        self.input_wait_seconds += time.perf_counter() - start
+        return item
+
+    def put(self, target_queue: queue.Queue, item) -> None:
+
+        start = time.perf_counter()
+        target_queue.put(item)
+        self.output_wait_seconds += time.perf_counter() - start
+
+    def report(self) -> str:
+
+        # Work spread over several workers is counted once per worker
+        busy_seconds = self.busy_seconds / self.parallelism
+        if self.rows:
+            amount, throughput = f"{self.rows} rows", f"{self.rows / busy_seconds:.0f} rows/s" if busy_seconds else '-'
+        else:
+            amount, throughput = f"{self.bytes / 1024 / 1024:.1f} MiB", f"{self.bytes / 1024 / 1024 / busy_seconds:.1f} MiB/s" if busy_seconds else '-'
+        return (f"{self.name:7} {self.files} file(s), {amount}, busy {busy_seconds:.2f} s ({throughput}), "
+                f"waited {self.input_wait_seconds:.2f} s for input and {self.output_wait_seconds:.2f} s on a full queue")
+
+def ingest_pipeline(excel_files: List[Tuple[str, str]], workers: int) -> List[Tuple[str, str]]:
+
+    # A reader thread loads the files, the parser stage turns them into rows and this thread writes the rows into the database,
+    # so that parsing, disk reads and inserts overlap
+    print(f"Reading {len(excel_files)} Excel file(s) with {workers} parser {'processes' if workers > 1 else 'thread'}")
+    read_queue = queue.Queue(maxsize=pipeline_queue_size)
+    write_queue = queue.Queue(maxsize=pipeline_queue_size)
+    pipeline_stop = threading.Event()
+    reader, parser, writer = PipelineStage('reader'), PipelineStage('parser', workers), PipelineStage('writer')
+    start_time = time.perf_counter()
+    # Under a memory budget every queued file has to fit into the ingest share, larger files are left on disk for the parser
+    read_ahead_bytes = memory_budget * 1024 * 1024 * memory_budget_shares['ingest'] / (pipeline_queue_size + 1) if memory_budget else None
+
+    def read_files():
+        try:
+            for file_path, file_name in excel_files:
+                if pipeline_stop.is_set():
+                    break
+                start = time.perf_counter()
+                try:
+                    if read_ahead_bytes and os.path.getsize(file_path) > read_ahead_bytes:
+                        report_spill(f"{file_name} ({os.path.getsize(file_path) / 1024 / 1024:.1f} MiB) is parsed straight from disk instead of being read ahead")
+                        reader.files += 1
+                        reader.put(read_queue, (file_path, file_name, None))
+                        continue
+                    with open(file_path, 'rb') as excel_file:
+                        content = excel_file.read()
+                except OSError as e:
+                    print(f"Error reading file {file_name}: {str(e)}")
+                    continue
+                finally:
+                    reader.busy_seconds += time.perf_counter() - start
+                reader.files += 1
+                reader.bytes += len(content)
+                reader.put(read_queue, (file_path, file_name, content))
+        finally:
+            read_queue.put(None)
+
+    def queue_batches(file_path: str, file_name: str, gene_data: List[Tuple[int, int, float]]) -> None:
+        parser.files += 1
+        parser.rows += len(gene_data)
+        # Every file is handed over in batches, so that no queue item and no single insert grows with the size of a file
+        for batch_start in range(0, max(len(gene_data), 1), pipeline_batch_rows):
+            if pipeline_stop.is_set():
+                return
+            parser.put(write_queue, (file_path, file_name, gene_data[batch_start:batch_start + pipeline_batch_rows], batch_start + pipeline_batch_rows >= len(gene_data)))
+
+    def parse_files():
+        try:
+            if workers == 1:
+                # In this thread the batches go to the writer while the sheet is still being read. Each batch is held back until the next one
+                # has been parsed, so that the last batch of a file can be marked as such without an extra empty batch
+                while not pipeline_stop.is_set() and (item := parser.get(read_queue)) is not None:
+                    file_path, file_name, content = item
+                    start, output_wait_seconds = time.perf_counter(), parser.output_wait_seconds
+                    file_rows = 0
+                    last_batch = []
+                    try:
+                        with profile_stage('read_file', file_name) as record:
+                            for batch_number, batch in enumerate(iter_gene_data_batches(file_path, use_parse_cache, content)):
+                                if pipeline_stop.is_set():
+                                    return
+                                if batch_number:
+                                    parser.put(write_queue, (file_path, file_name, last_batch, False))
+                                file_rows += len(batch)
+                                last_batch = batch
+                            record['rows'] = file_rows
+                    except Exception as e:
+                        print(f"Error reading file {file_name}: {str(e)}")
+                        # Tells the writer to drop the batches of the file it has already received
+                        parser.put(write_queue, (file_path, file_name, None, True))
+                        continue
+                    finally:
+                        parser.busy_seconds += time.perf_counter() - start - (parser.output_wait_seconds - output_wait_seconds)
+                    parser.files += 1
+                    parser.rows += file_rows
+                    parser.put(write_queue, (file_path, file_name, last_batch, True))
+                return
+
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                running = {}
+                reading = True
+                while reading or running:
+                    # At most one file per worker process is handed out, the others wait in the read queue
+                    while reading and len(running) < workers and not pipeline_stop.is_set():
+                        item = parser.get(read_queue)
+                        if item is None:
+                            reading = False
+                            break
+                        file_path, file_name, content = item
+                        running[executor.submit(timed_parse_file, file_path, use_parse_cache, content)] = (file_path, file_name)
+                    if not running:
+                        break
+                    finished, unfinished = wait_futures(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        file_path, file_name = running.pop(future)
+                        try:
+                            gene_data, wall_seconds, cpu_seconds = future.result()
+                        except Exception as e:
+                            print(f"Error reading file {file_name}: {str(e)}")
+                            continue
+                        parser.busy_seconds += wall_seconds
+                        add_profile_record({'stage': 'read_file', 'detail': file_name, 'rows': len(gene_data), 'wall_seconds': wall_seconds, 'cpu_seconds': cpu_seconds})
+                        queue_batches(file_path, file_name, gene_data)
+        finally:
+            write_queue.put(None)
+
+    reader_thread = threading.Thread(target=read_files, daemon=True)
+    parser_thread = threading.Thread(target=parse_files, daemon=True)
+    reader_thread.start()
+    parser_thread.start()
+
+    ingested_files = []
+    failed_files = set()
+    # The in-memory engine needs every file in one piece, so its batches are put back together here
+    pending_gene_data = {}
+
+    def drop_file(file_path: str, file_name: str) -> None:
+        # Batches of the file that have already been written are dropped again
+        failed_files.add(file_path)
+        pending_gene_data.pop(file_path, None)
+        if engine == 'sqlite':
+            remove_file(conn, file_path)
+
+    try:
+        while (item := writer.get(write_queue)) is not None:
+            file_path, file_name, batch, last_batch = item
+            if file_path in failed_files:
+                continue
+            if batch is None:
+                drop_file(file_path, file_name)
+                continue
+            start = time.perf_counter()
+            try:
+                if engine == 'memory':
+                    pending_gene_data.setdefault(file_path, []).extend(batch)
+                    if last_batch:
+                        add_gene_data(conn, file_path, file_name, pending_gene_data.pop(file_path))
+                else:
+                    add_gene_data(conn, file_path, file_name, batch)
+                    if last_batch and persistent_store:
+                        record_source_file(conn, file_path)
+            except Exception as e:
+                print(f"Error adding {file_name} into database: {str(e)}")
+                drop_file(file_path, file_name)
+                continue
+            finally:
+                writer.busy_seconds += time.perf_counter() - start
+            writer.rows += len(batch)
+            if last_batch:
+                writer.files += 1
+                ingested_files.append((file_path, file_name))
+                print(f"Added {file_name} into database")
+                if memory_budget:
+                    check_database_spill(conn)
+                    check_memory_budget(f"adding {file_name}")
+    finally:
+        # Stopping early (e.g. on Ctrl+C) empties the queues, so that the reader and the parsers are not left waiting on them
+        pipeline_stop.set()
+        while reader_thread.is_alive() or parser_thread.is_alive():
+            for pending_queue in (read_queue, write_queue):
+                try:
+                    # The end-of-input marker is put back, the thread waiting for it would never wake up otherwise
+                    if pending_queue.get_nowait() is None:
+                        pending_queue.put_nowait(None)
+                except queue.Empty:
+                    pass
+            parser_thread.join(0.01)
+
+    print(f"Ingest pipeline finished in {time.perf_counter() - start_time:.2f} s")
+    stages = [reader, parser, writer]
+    for stage in stages:
+        print(f"  {stage.report()}")
+    print(f"  Slowest stage: {max(stages, key=lambda stage: stage.busy_seconds / stage.parallelism).name}")
+    return ingested_files
+
+def excel_file_stats(excel_files: List[Tuple[str, str]]) -> Dict[str, Tuple[str, int, float]]:
+
+    file_stats = {}
+    for file_path, file_name in excel_files:
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        file_stats[file_path] = (file_name, stat.st_size, stat.st_mtime)
+    return file_stats
+
+def start_input_watcher() -> None:
+
+    global watcher_thread
+    watcher_stop.clear()
+    watcher_thread = threading.Thread(target=watch_input_directory, args=(excel_file_stats(find_excel_files()),), daemon=True)
+    watcher_thread.start()
+    print(f"Watching {input_directory} for new or changed Excel files every {watch_interval} seconds")
+
+def stop_input_watcher() -> None:
+
+    if watcher_thread and watcher_thread.is_alive():
+        watcher_stop.set()
+        # The watcher is a daemon thread, if it is still reading a large file it is left behind rather than waited for
+        watcher_thread.join(watcher_stop_timeout)
+        if watcher_thread.is_alive():
+            print(f"Input watcher did not stop within {watcher_stop_timeout} seconds, leaving it behind")
+
+def watch_input_directory(known_files: Dict[str, Tuple[str, int, float]]) -> None:
+
+    # SQLite connections cannot be shared between threads, so the watcher writes through its own
+    watch_conn = sqlite3.connect(database_path) if engine == 'sqlite' else None
+    if watch_conn:
+        apply_sqlite_pragmas(watch_conn)
+    previous_files = dict(known_files)
+    try:
+        while not watcher_stop.wait(watch_interval):
+            current_files = excel_file_stats(find_excel_files())
+            refreshed = False
+            for file_path, file_stat in current_files.items():
+                # A file is only read once its size and modification time have not moved since the last poll, files still being copied are left alone
+                if known_files.get(file_path) != file_stat and previous_files.get(file_path) == file_stat:
+                    if refresh_file(watch_conn, file_path, file_stat[0], file_path in known_files):
+                        known_files[file_path] = file_stat
+                        refreshed = True
+            for file_path in set(known_files) - set(current_files):
+                file_name = known_files.pop(file_path)[0]
+                refreshed = refresh_file(watch_conn, file_path, file_name, True, removed=True) or refreshed
+            # The snapshot is rewritten once per poll, queries keep reading the previous mapping until the new matrix replaces it
+            if refreshed and engine == 'memory' and snapshot_path:
+                write_snapshot(gene_matrix, known_files)
+            previous_files = current_files
+    finally:
+        if watch_conn:
+            watch_conn.close()
+
+def refresh_file(watch_conn: sqlite3.Connection, file_path: str, file_name: str, known: bool, removed: bool = False) -> bool:
+
+    global gene_matrix
+    gene_data = None
+    if not removed:
+        try:
+            gene_data = parse_file(file_path, use_parse_cache)
+        except Exception as e:
+            print(f"\nInput watcher: error reading file {file_name}: {str(e)}, trying again later")
+            return False
+
+    if engine == 'memory':
+        gene_matrix = gene_matrix.replace_file(source_path(file_path), file_name, gene_data)
+    else:
+        # The old rows are deleted and the new ones inserted in one transaction, a query running meanwhile sees either the old or the new file
+        try:
+            watch_conn.execute("BEGIN IMMEDIATE")
+            remove_file(watch_conn, file_path)
+            if not removed:
+                add_gene_data(watch_conn, file_path, file_name, gene_data)
+                if persistent_store:
+                    record_source_file(watch_conn, file_path)
+            watch_conn.commit()
+        except Exception as e:
+            watch_conn.rollback()
+            print(f"\nInput watcher: error adding {file_name} into database: {str(e)}, trying again later")
+            return False
+    invalidate_query_cache()
+
+    if removed:
+        print(f"\nInput watcher: {file_name} is no longer in {input_directory}, removed it from database")
+    else:
+        print(f"\nInput watcher: {file_name} has been {'updated' if known else 'added'} in database ({len(gene_data)} rows)")
+    return True
+
+def iter_topx_file(file_path: str):
+
+    # Yields (comparison, None) for every comparison header and (comparison, gene_id) for every gene ID listed under it,
+    # gene IDs that come before the first header are yielded with comparison None
+    comparison = None
+    with open(file_path, 'r') as file:
+        for line in file:
+            line = rtf_markup_pattern.sub(' ', line)
+            for token in topx_token_pattern.finditer(line):
+                if token.lastgroup == 'comparison':
+                    comparison = token.group()
+                    yield comparison, None
+                else:
+                    yield comparison, token.group()
 
 def auto_match():
 
@@ -187,9 +1593,8 @@ def auto_match():
     txt_files = [f for f in os.listdir(input_directory) if f.endswith('.txt')]
 
     if len(txt_files) == 1:
+        txt_file = txt_files[0]
         print(f"Reading from {txt_files}")
-        with open(os.path.join(input_directory, txt_files[0]), 'r') as file:
-            data = file.readlines()
     else:
         print(f"Found {len(txt_files)} TXT files in {input_directory}:")
         for i, txt_file in enumerate(txt_files):
@@ -204,122 +1609,629 @@ def auto_match():
                     break
             except ValueError:
                 print("Invalid input. Please enter a number.")
-        with open(os.path.join(input_directory, txt_files[txt_index]), 'r') as file:
-            data = file.readlines()
-
-    vs_pattern = re.compile(r'T\d+VsC\d+|T\d+vsC\d+|t\d+vsC\d+|T\d+vsc\d+|t\d+vs\d+')
-    c_pattern = re.compile(r'C\d+\.\d+')
-    unique_c_values = set()
-    unique_vs_values = set()
-    values = {}
-    for line in data:
-        line = line.strip()
-        vs_matches = vs_pattern.findall(line)
-        c_matches = c_pattern.findall(line)
-        if vs_matches:
-            for match in vs_matches:
-                unique_vs_values.add(match)
-                if match not in values:
-                    values[match] = []
-        elif c_matches:
-            for match in c_matches:
-                unique_c_values.add(match)
-                for key in values:
-                    if key in line:
-                        values[key].append(match)
-        else:
-            continue
+        txt_file = txt_files[txt_index]
 
-    unique_c_values = natsort.natsorted(unique_c_values, key=lambda x: float(re.findall(r'\d+\.\d+', x)[0]) if re.findall(r'\d+\.\d+', x) else float('inf'), alg=natsort.REAL)
-    unique_vs_values = natsort.natsorted(unique_vs_values, key=lambda x: float(re.findall(r'\d+', x)[0]), alg=natsort.REAL)  
-    
-    # Create a dataframe
-    df = pd.DataFrame(columns=['Gene ID'] + list(unique_vs_values))
+    match_txt_file(os.path.join(input_directory, txt_file))
+    print_dynamic_line('Automatic matching completed')
 
-    if len(df.columns) != len(unique_vs_values) + 1:
-        print(f"Number of columns ({len(df.columns)}) does not match length of unique_vs_values ({len(unique_vs_values)})")
-        return
+def match_txt_file(txt_path: str, cursor: sqlite3.Cursor = None) -> str:
 
-    for c_number in sorted(unique_c_values):
-        # Create a new row with the c value
-        row = [c_number]
-        
-        while len(row) < len(unique_vs_values) + 1:
-            row.append('')
-
-        gene_data_list = search_gene_data(c_number)
-
-        if gene_data_list:
-            for file_name in unique_vs_values:
-                match_found = False
-                
-                for gene_data in gene_data_list:
-                    gene_file, gene_log2foldchange = gene_data
-                    gene_file = os.path.splitext(gene_file)[0]
-                    if gene_file == file_name:
-                        col_index = list(unique_vs_values).index(file_name) + 1
-                        row[col_index] = gene_log2foldchange
-                        match_found = True
-                        break
-                
-                # If no match was found for the current sample
-                if not match_found:
-                    col_index = list(unique_vs_values).index(file_name) + 1
-                    row += [''] * (col_index - len(row))
-                    row[col_index] = ''
-        
-        # Append the row to the DataFrame
-        df = pd.concat([df, pd.DataFrame([row], columns=df.columns)], ignore_index=True)
-
-    # Write the dataframe to an Excel file
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-    output_file_path = os.path.join(output_directory, auto_match_output_filename)
+    header, rows = iter_match_rows(txt_path, cursor)
+    # Stream the rows into an output file named after the TXT file
+    output_file_path = os.path.join(output_directory, f"{os.path.splitext(os.path.basename(txt_path))[0]}.{output_format}")
+    export_output(output_file_path, header, rows)
+    return output_file_path
+
+def read_match_list(txt_path: str) -> Tuple[List[str], List[str]]:
+
+    # Returns the comparisons of a TXT file in natural order and its gene IDs in sorted order
+    import natsort
+    with profile_stage('match_parse', os.path.basename(txt_path)) as record:
+        unique_c_values = set()
+        unique_vs_values = set()
+        for comparison, gene_id in iter_topx_file(txt_path):
+            if gene_id is None:
+                unique_vs_values.add(comparison)
+            else:
+                unique_c_values.add(gene_id)
+
+        unique_vs_values = natsort.natsorted(unique_vs_values, key=lambda x: float(re.findall(r'\d+', x)[0]), alg=natsort.REAL)  
+        record['rows'] = len(unique_c_values)
+    return unique_vs_values, sorted(unique_c_values)
+
+def match_block(txt_file: str, gene_ids: List[str], comparisons: List[str], cursor: sqlite3.Cursor = None) -> Tuple[np.ndarray, int]:
+
+    # Returns a gene x comparison matrix holding None where a gene has no value, and the number of genes found in any comparison
+    with profile_stage('match_lookup', txt_file) as record:
+        positions, columns, values = search_comparison_hits(gene_ids, comparisons, cursor)
+        record['rows'] = len(positions)
+
+    with profile_stage('match_pivot', txt_file) as record:
+        # Scatter all hits into the gene x comparison matrix in one step, genes without a value in a comparison stay empty
+        matrix = np.full((len(gene_ids), len(comparisons)), None, dtype=object)
+        # A missing log2FoldChange becomes None as well, so that every exporter writes it like a gene the sheet does not hold
+        cell_values = values.astype(object)
+        cell_values[np.isnan(values)] = None
+        matrix[positions, columns] = cell_values
+        record['rows'] = len(positions)
+    return matrix, len(np.unique(positions))
+
+def iter_match_rows(txt_path: str, cursor: sqlite3.Cursor = None):
+
+    # Returns the output header and a generator of output rows. Without a memory budget the whole gene ID list is one block,
+    # with one the list is matched block by block as the exporter asks for the rows, so only one block is held at a time
+    txt_file = os.path.basename(txt_path)
+    comparisons, gene_ids = read_match_list(txt_path)
+    block_rows = match_block_rows(len(comparisons)) or max(len(gene_ids), 1)
+    if len(gene_ids) > block_rows:
+        report_spill(f"matching {txt_file} in {-(-len(gene_ids) // block_rows)} blocks of {block_rows} gene IDs")
+    # The first block is matched right away, so that a failing lookup is raised before an output file is started
+    return ['Gene ID'] + comparisons, match_rows(txt_file, gene_ids, comparisons, cursor, block_rows, *match_block(txt_file, gene_ids[:block_rows], comparisons, cursor))
+
+def match_rows(txt_file: str, gene_ids: List[str], comparisons: List[str], cursor: sqlite3.Cursor, block_rows: int, matrix: np.ndarray, block_genes: int):
+
+    found_genes = 0
+    for block_start in range(0, len(gene_ids), block_rows):
+        if block_start:
+            check_memory_budget(f"matching {txt_file}")
+            matrix, block_genes = match_block(txt_file, gene_ids[block_start:block_start + block_rows], comparisons, cursor)
+        found_genes += block_genes
+        for gene_id, values in zip(gene_ids[block_start:block_start + block_rows], matrix.tolist()):
+            yield [gene_id] + values
+    print(f"Result(s) found for {found_genes} of {len(gene_ids)} gene ID(s)")
+
+def export_output(output_file_path: str, header: List[str], rows) -> None:
+
+    os.makedirs(output_directory, exist_ok=True)
+    # Every exporter writes under a temporary name first, only the final rename has to wait for other applications to release the file
+    partial_file_path = output_file_path + '.part'
+    with profile_stage('export', os.path.basename(output_file_path)) as record:
+        try:
+            export_table(partial_file_path, header, count_rows(rows, record), output_format)
+        except BaseException:
+            # A failed or interrupted export leaves no half-written file behind in output_directory
+            if os.path.exists(partial_file_path):
+                os.remove(partial_file_path)
+            raise
+
+    output_file_name = os.path.basename(output_file_path)
     while True:
         try:
-            df.to_excel(output_file_path, index=False)
-            print(f"output.xlsx has been generated in {output_directory}")
+            os.replace(partial_file_path, output_file_path)
+            print(f"{output_file_name} has been generated in {output_directory}")
             break
         except PermissionError:
-            print(f"Error: Permission denied to write to {output_file_path}. If you have other application using output.xlsx, close it can be written to\nWaiting for 5 seconds before trying again...")
+            print(f"Error: Permission denied to write to {output_file_path}. If you have other application using {output_file_name}, close it can be written to\nWaiting for 5 seconds before trying again...")
             wait(5)
-    print_dynamic_line('Automatic matching completed')
+
+def export_table(file_path: str, header: List[str], rows, file_format: str) -> None:
+
+    if file_format == 'xlsx':
+        export_xlsx(file_path, header, rows)
+    elif file_format == 'csv':
+        export_delimited(file_path, header, rows, ',')
+    elif file_format == 'tsv':
+        export_delimited(file_path, header, rows, '\t')
+    else:
+        export_arrow(file_path, header, rows, file_format)
+
+def count_rows(rows, record: Dict):
+
+    # Rows are generated lazily while the exporter writes them, so they are counted on the way through
+    record['rows'] = 0
+    for row in rows:
+        record['rows'] += 1
+        yield row
+
+def export_xlsx(file_path: str, header: List[str], rows) -> None:
+
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Font
+    # Write-only mode flushes every appended row to disk, so memory use does not grow with the number of rows
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Sheet1')
+    header_cells = []
+    for title in header:
+        cell = WriteOnlyCell(worksheet, value=title)
+        cell.font = Font(bold=True)
+        cell.alignment = Alignment(horizontal='center')
+        header_cells.append(cell)
+    worksheet.append(header_cells)
+    for row in rows:
+        worksheet.append(row)
+    workbook.save(file_path)
+
+def export_delimited(file_path: str, header: List[str], rows, delimiter: str) -> None:
+
+    with open(file_path, 'w', newline='') as file:
+        writer = csv.writer(file, delimiter=delimiter)
+        writer.writerow(header)
+        # Genes without a value in a comparison are written as empty fields
+        writer.writerows(rows)
+
+def export_arrow(file_path: str, header: List[str], rows, file_format: str) -> None:
+
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    # Arrow files are columnar, so the rows are collected into one list per column, a record batch of export_batch_rows rows at a time
+    schema = pa.schema([pa.field(header[0], pa.string())] + [pa.field(title, pa.float64()) for title in header[1:]])
+    if file_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(file_path, schema)
+    else:
+        # Feather version 2 is the Arrow IPC file format, compressed with LZ4 when available like pyarrow.feather.write_feather() does
+        writer = pyarrow.ipc.new_file(file_path, schema, options=pyarrow.ipc.IpcWriteOptions(compression='lz4' if pa.Codec.is_available('lz4') else None))
+    rows = iter(rows)
+    with writer:
+        while True:
+            columns = [[] for _ in header]
+            for row in itertools.islice(rows, export_batch_rows):
+                for column, value in zip(columns, row):
+                    column.append(value)
+            if not columns[0]:
+                break
+            writer.write_batch(pa.record_batch([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+
+def lookup_genes(gene_ids: List[str]) -> int:
+
+    # One-shot lookup from the command line, with --persistent only new or changed Excel files are read before answering
+    if not os.path.isdir(input_directory):
+        print(f"{input_directory} directory was not found")
+        return 1
+    if engine == 'sqlite':
+        setup_database()
+    if not ingest_input_directory():
+        print(f"No Excel file detected in {input_directory}")
+        return 1
+    for gene_id in gene_ids:
+        if cluster_prefix_pattern.match(gene_id):
+            search_cluster_data(gene_id)
+        else:
+            search_gene_data(gene_id)
+    return 0
 
 def manual_match():
     print_dynamic_line('Manual matching start')
     # Search for gene data
-    gene_id = input("Enter Gene ID: ")
-    search_gene_data(gene_id)
+    gene_id = input("Enter Gene ID (or a cluster followed by .* for all of its subclusters): ")
+    if cluster_prefix_pattern.match(gene_id):
+        search_cluster_data(gene_id)
+    else:
+        search_gene_data(gene_id)
     print_dynamic_line('Manual matching completed')
 
+def find_txt_files(txt_patterns: List[str]) -> List[str]:
+
+    # Without patterns every TXT file in the input directory is used, patterns that match nothing as given are looked up in the input directory
+    if not txt_patterns:
+        txt_patterns = [os.path.join(input_directory, '*.txt')]
+    txt_paths = []
+    for txt_pattern in txt_patterns:
+        matches = sorted(glob.glob(txt_pattern)) or sorted(glob.glob(os.path.join(input_directory, txt_pattern)))
+        if not matches:
+            print(f"No TXT file matches {txt_pattern}")
+        txt_paths += [txt_path for txt_path in matches if txt_path not in txt_paths]
+    return txt_paths
+
+def match_txt_files_concurrently(txt_paths: List[str], jobs: int) -> List[str]:
+
+    print(f"Matching {len(txt_paths)} TXT file(s) with {jobs} concurrent jobs")
+    # Every worker thread lazily opens one read-only connection to the store, the in-memory engine shares its arrays instead
+    def match_with_worker_connection(txt_path: str) -> str:
+        print(f"Matching {txt_path}")
+        return match_txt_file(txt_path, read_only_cursor() if engine == 'sqlite' else None)
+
+    failed_txt_files = []
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(match_with_worker_connection, txt_path): txt_path for txt_path in txt_paths}
+            for future in as_completed(futures):
+                txt_path = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error matching {txt_path}: {str(e)}")
+                    failed_txt_files.append(txt_path)
+    finally:
+        close_read_only_connections()
+    return failed_txt_files
+
+def batch_match(txt_patterns: List[str]) -> int:
+
+    print_dynamic_line('Batch matching start')
+    if not os.path.isdir(input_directory):
+        print(f"{input_directory} directory was not found")
+        return 1
+    txt_paths = find_txt_files(txt_patterns)
+    if not txt_paths:
+        print("No TXT file to match, nothing to do")
+        return 1
+
+    # Ingest once, then every TXT file is matched against the same loaded store
+    if engine == 'sqlite':
+        setup_database()
+    if not ingest_input_directory():
+        print(f"No Excel file detected in {input_directory}")
+        return 1
+
+    failed_txt_files = []
+    if match_jobs > 1 and len(txt_paths) > 1:
+        failed_txt_files = match_txt_files_concurrently(txt_paths, match_jobs)
+    else:
+        for txt_path in txt_paths:
+            print(f"Matching {txt_path}")
+            try:
+                match_txt_file(txt_path)
+            except Exception as e:
+                print(f"Error matching {txt_path}: {str(e)}")
+                failed_txt_files.append(txt_path)
+    print(f"{len(txt_paths) - len(failed_txt_files)} of {len(txt_paths)} TXT file(s) matched, output written to {output_directory}")
+    print_dynamic_line('Batch matching completed')
+    return 1 if failed_txt_files else 0
+
+def json_value(value):
+
+    # JSON has no NaN, missing values are sent as null like NULL values coming out of SQLite
+    return None if value is None or (isinstance(value, float) and np.isnan(value)) else value
+
+def gene_data_json(gene_id: str, gene_key_form: str, gene_data_list: List[Tuple[str, float]]) -> Dict:
+
+    return {'gene_id': gene_id, 'gene_key': gene_key_form, 'results': [{'file_name': file_name, 'log2foldchange': json_value(log2foldchange)} for file_name, log2foldchange in gene_data_list]}
+
+def json_response(status: int, payload: Dict) -> Tuple[int, str, bytes, str]:
+
+    return status, 'application/json', json.dumps(payload).encode('utf-8'), None
+
+def handle_api_request(method: str, path: str, query: Dict[str, List[str]], body: bytes) -> Tuple[int, str, bytes, str]:
+
+    # Runs in a worker thread of the server, returns the status, the content type, the body and the path of a file to stream instead of the body
+    parts = [urllib.parse.unquote(part) for part in path.strip('/').split('/')]
+    if method == 'GET' and parts == ['status']:
+        file_names = gene_matrix.file_names if engine == 'memory' else [row[0] for row in current_cursor().execute("SELECT file_name FROM files")]
+        import natsort
+        return json_response(200, {'engine': engine, 'files': natsort.natsorted(file_names)})
+
+    if method == 'GET' and len(parts) == 2 and parts[0] == 'genes':
+        try:
+            cluster, subcluster = gene_key(parts[1])
+        except IndexError:
+            return json_response(400, {'error': f"{parts[1]} is not a gene ID"})
+        return json_response(200, gene_data_json(parts[1], gene_key_text(cluster, subcluster), query_gene_key(cluster, subcluster)))
+
+    if method == 'GET' and len(parts) == 2 and parts[0] == 'clusters':
+        if not parts[1].isdigit():
+            return json_response(400, {'error': f"{parts[1]} is not a cluster number"})
+        subclusters, file_names, block = search_cluster_block(int(parts[1]))
+        return json_response(200, {'cluster': int(parts[1]), 'file_names': file_names,
+                                   'subclusters': [{'subcluster': subcluster, 'values': [json_value(value) for value in values]} for subcluster, values in zip(subclusters, block.tolist())]})
+
+    if method == 'POST' and parts == ['genes']:
+        try:
+            gene_ids = [str(gene_id) for gene_id in json.loads(body)['gene_ids']]
+        except (ValueError, KeyError, TypeError):
+            return json_response(400, {'error': 'expected a JSON object with a list of gene_ids'})
+        gene_data_lists = search_gene_data_bulk(gene_ids)
+        genes = []
+        for gene_id in gene_ids:
+            if gene_id in gene_data_lists:
+                genes.append(gene_data_json(gene_id, gene_key_text(*gene_key(gene_id)), gene_data_lists[gene_id]))
+            else:
+                genes.append({'gene_id': gene_id, 'error': f"{gene_id} is not a gene ID"})
+        return json_response(200, {'genes': genes})
+
+    if method == 'POST' and len(parts) == 2 and parts[0] == 'match':
+        file_format = query.get('format', ['json'])[0]
+        if file_format not in ['json'] + output_formats:
+            return json_response(400, {'error': f"format must be one of {', '.join(['json'] + output_formats)}"})
+        if file_format in ['parquet', 'feather'] and importlib.util.find_spec('pyarrow') is None:
+            return json_response(400, {'error': f"format {file_format} needs pyarrow to be installed on the server"})
+        # The uploaded TXT file and the output only live in the system temporary directory, concurrent jobs with the same name do not collide
+        txt_fd, txt_path = tempfile.mkstemp(suffix='.txt')
+        try:
+            with os.fdopen(txt_fd, 'wb') as txt_file:
+                txt_file.write(body)
+            header, rows = iter_match_rows(txt_path)
+        finally:
+            os.remove(txt_path)
+        if file_format == 'json':
+            return json_response(200, {'txt_file': parts[1], 'header': header, 'rows': [[json_value(value) for value in row] for row in rows]})
+        output_fd, output_path = tempfile.mkstemp(suffix=f'.{file_format}')
+        os.close(output_fd)
+        try:
+            export_table(output_path, header, rows, file_format)
+        except Exception:
+            os.remove(output_path)
+            raise
+        return 200, 'application/octet-stream', b'', output_path
+
+    return json_response(404, {'error': f"{method} {path} is not a known request"})
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, executor: ThreadPoolExecutor) -> None:
+
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            return
+        method, target = request_line[0], request_line[1]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        # Lookups and matching block on SQLite or NumPy, so they run in the worker threads while the event loop keeps accepting requests
+        url = urllib.parse.urlsplit(target)
+        try:
+            status, content_type, payload, file_path = await asyncio.get_running_loop().run_in_executor(executor, handle_api_request, method, url.path, urllib.parse.parse_qs(url.query), body)
+        except Exception as e:
+            status, content_type, payload, file_path = json_response(500, {'error': str(e)})
+        print(f"{method} {url.path} {status}")
+
+        content_length = os.path.getsize(file_path) if file_path else len(payload)
+        writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\nContent-Length: {content_length}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+        if file_path:
+            # Output files are streamed in chunks rather than loaded into memory as a whole
+            try:
+                with open(file_path, 'rb') as output_file:
+                    while chunk := output_file.read(65536):
+                        writer.write(chunk)
+                        await writer.drain()
+            finally:
+                os.remove(file_path)
+        else:
+            writer.write(payload)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def run_server() -> None:
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    connections = set()
+
+    async def accept_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        connections.add(task)
+        try:
+            await handle_connection(reader, writer, executor)
+        finally:
+            connections.discard(task)
+
+    # SIGTERM only stops accepting requests, the requests being answered are finished before main() cleans up the database they read from
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    with ThreadPoolExecutor(max_workers=server_workers) as executor:
+        server = await asyncio.start_server(accept_connection, server_host, server_port)
+        print(f"Query server is listening on http://{server_host}:{server_port} with {server_workers} workers, press Ctrl+C to stop")
+        async with server:
+            await stop.wait()
+            print(f"Received signal {signal.SIGTERM.value}, stopping the query server...")
+            server.close()
+            if connections:
+                await asyncio.wait(connections)
+
+def serve() -> int:
+
+    print_dynamic_line('Query server start')
+    if engine == 'sqlite':
+        setup_database()
+    if not ingest_input_directory():
+        print(f"No Excel file detected in {input_directory}")
+        return 1
+    if watch_interval:
+        start_input_watcher()
+    asyncio.run(run_server())
+    # The event loop puts the default SIGTERM handler back when it closes
+    signal.signal(signal.SIGTERM, handler)
+    return 0
+
+def query_server(gene_ids: List[str], txt_patterns: List[str]) -> int:
+
+    server_url = f"http://{server_host}:{server_port}"
+    cluster_prefixes = [gene_id for gene_id in gene_ids or [] if cluster_prefix_pattern.match(gene_id)]
+    gene_ids = [gene_id for gene_id in gene_ids or [] if gene_id not in cluster_prefixes]
+    try:
+        for cluster_prefix in cluster_prefixes:
+            cluster = int(cluster_prefix_pattern.match(cluster_prefix).group(1))
+            with urllib.request.urlopen(f"{server_url}/clusters/{cluster}") as response:
+                cluster_data = json.load(response)
+            print_cluster_data(cluster, [row['subcluster'] for row in cluster_data['subclusters']], cluster_data['file_names'],
+                               np.array([[np.nan if value is None else value for value in row['values']] for row in cluster_data['subclusters']], dtype=np.float64))
+
+        if gene_ids:
+            request = urllib.request.Request(f"{server_url}/genes", data=json.dumps({'gene_ids': gene_ids}).encode('utf-8'), method='POST', headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request) as response:
+                for gene in json.load(response)['genes']:
+                    if 'error' in gene:
+                        print(f"Error getting data for gene {gene['gene_id']}: {gene['error']}")
+                    else:
+                        print_gene_data(gene['gene_key'], [(result['file_name'], result['log2foldchange']) for result in gene['results']])
+
+        for txt_path in find_txt_files(txt_patterns) if txt_patterns else []:
+            txt_file = os.path.basename(txt_path)
+            with open(txt_path, 'rb') as txt:
+                request = urllib.request.Request(f"{server_url}/match/{urllib.parse.quote(txt_file)}?format={output_format}", data=txt.read(), method='POST', headers={'Content-Type': 'text/plain'})
+            os.makedirs(output_directory, exist_ok=True)
+            output_file_path = os.path.join(output_directory, f"{os.path.splitext(txt_file)[0]}.{output_format}")
+            with urllib.request.urlopen(request) as response, open(output_file_path + '.part', 'wb') as output_file:
+                shutil.copyfileobj(response, output_file)
+            os.replace(output_file_path + '.part', output_file_path)
+            print(f"{os.path.basename(output_file_path)} has been generated in {output_directory}")
+    except urllib.error.HTTPError as e:
+        try:
+            error = json.load(e)['error']
+        except (ValueError, KeyError):
+            error = e.reason
+        print(f"Query server error {e.code}: {error}")
+        return 1
+    except urllib.error.URLError as e:
+        print(f"No query server is running on {server_url}: {e.reason}")
+        return 1
+    return 0
+
 def initialization():
-    setup_database()
+    if engine == 'sqlite':
+        setup_database()
     
     continue_with_automatch = precheck_source()
+    if watch_interval:
+        start_input_watcher()
 
     print("Initialization completed\nReady for query")
     print_dynamic_line('')
     return continue_with_automatch
 
+def parse_arguments():
+
+    global persistent_store, bulk_load, ingest_workers, use_parse_cache, output_format, engine, match_jobs
+    global input_directory, output_directory, profiling, cprofile_stage, watch_interval
+    global server_host, server_port, server_workers, snapshot_path, memory_budget
+    parser = argparse.ArgumentParser(description='RNA Sequence Analysis Application for Excel (.xls or .xlsx) Files')
+    parser.add_argument('--persistent', action='store_true', help=f'keep the database in {store_directory} between runs and only read new or changed Excel files')
+    parser.add_argument('--snapshot', nargs='?', const=os.path.join(store_directory, snapshot_name), metavar='PATH', help='use the in-memory engine and keep the loaded data in one memory-mapped snapshot file, which is opened instead of reading the Excel files again while none of them has changed (default path: %(const)s)')
+    parser.add_argument('--no-bulk-load', action='store_true', help='commit every Excel file separately and keep the gene key index up to date during the inserts')
+    parser.add_argument('--sqlite-pragma', action='append', default=[], metavar='NAME=VALUE', help='set a SQLite pragma on the connections writing to the database, e.g. synchronous=FULL, can be given several times')
+    parser.add_argument('--memory-budget', type=int, default=memory_budget, metavar='MIB', help='keep the resident memory under MIB mebibytes by ingesting and matching in chunks against the database on disk, 0 means no budget (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=ingest_workers, help='number of worker processes used to read Excel files, 0 uses every CPU core (default: %(default)s)')
+    parser.add_argument('--cache', action='store_true', help=f'keep every parsed Excel sheet in {cache_directory} so that unchanged files are never parsed twice')
+    parser.add_argument('--prune-cache', action='store_true', help=f'delete cache entries in {cache_directory} that no longer match a file in {input_directory} and exit')
+    parser.add_argument('--format', choices=output_formats, default=output_format, help='file format of the auto-matching output (default: %(default)s)')
+    parser.add_argument('--engine', choices=engines, default=engine, help='query engine, memory holds all values in a NumPy matrix instead of a SQLite database (default: %(default)s)')
+    parser.add_argument('--input-dir', default=input_directory, help='directory holding the Excel files and TXT files (default: %(default)s)')
+    parser.add_argument('--output-dir', default=output_directory, help='directory the auto-matching output is written to (default: %(default)s)')
+    parser.add_argument('--watch', type=float, nargs='?', const=10, default=watch_interval, metavar='SECONDS', help='keep polling the input directory while the application is running and load new, changed or removed Excel files (default interval: %(const)s seconds)')
+    parser.add_argument('--batch', action='store_true', help='match the TXT files given with --txt without prompting, then exit')
+    parser.add_argument('--txt', nargs='+', metavar='TXT', help='TXT files or glob patterns to match in batch mode, names are also looked up in the input directory (default: every TXT file in the input directory)')
+    parser.add_argument('--serve', action='store_true', help='load the store once and answer gene lookups and matching jobs over HTTP until stopped with Ctrl+C')
+    parser.add_argument('--connect', action='store_true', help='send the --lookup and --txt requests to a running query server instead of loading the store')
+    parser.add_argument('--lookup', nargs='+', metavar='GENE_ID', help='gene IDs or clusters followed by .* to look up and print, then exit, on the query server when given with --connect')
+    parser.add_argument('--host', default=server_host, help='address the query server listens on or is reached at (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=server_port, help='port of the query server (default: %(default)s)')
+    parser.add_argument('--server-workers', type=int, default=server_workers, help='number of requests the query server works on at the same time (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=match_jobs, help='number of TXT files matched at the same time in batch mode (default: %(default)s)')
+    parser.add_argument('--query-cache-size', type=int, default=query_cache_size, help='number of gene lookups kept in the query cache, 0 disables the cache (default: %(default)s)')
+    parser.add_argument('--profile', action='store_true', help=f'record wall time, CPU time and row counts of every stage and write them to {profile_report_name} in the output directory at exit')
+    parser.add_argument('--cprofile', choices=profile_stages, metavar='STAGE', help=f'run STAGE under cProfile and write STAGE.prof to the output directory at exit, one of: {", ".join(profile_stages)}')
+    args = parser.parse_args()
+    if args.txt and not (args.batch or args.connect):
+        parser.error("--txt can only be used with --batch or --connect")
+    if args.lookup and (args.batch or args.serve):
+        parser.error("--lookup cannot be used with --batch or --serve")
+    if args.connect and not (args.lookup or args.txt):
+        parser.error("--connect needs --lookup or --txt")
+    if sum([args.batch, args.serve, args.connect]) > 1:
+        parser.error("--batch, --serve and --connect cannot be used together")
+    if args.watch and (args.batch or args.lookup):
+        parser.error("--watch cannot be used with --batch or --lookup")
+    if args.engine == 'memory' and args.persistent:
+        parser.error("--persistent can only be used with --engine sqlite")
+    if args.memory_budget and (args.engine == 'memory' or args.snapshot):
+        parser.error("--memory-budget keeps the data on disk and can only be used with --engine sqlite")
+    if args.snapshot and args.persistent:
+        parser.error("--snapshot cannot be used with --persistent, the snapshot already keeps the data between runs")
+    if args.format in ['parquet', 'feather'] and not args.connect and importlib.util.find_spec('pyarrow') is None:
+        parser.error(f"--format {args.format} requires pyarrow, install it with: pip install pyarrow")
+    memory_budget = max(args.memory_budget, 0)
+    if memory_budget:
+        configure_memory_budget()
+    sqlite_pragma_overrides = {}
+    for sqlite_pragma in args.sqlite_pragma:
+        match = sqlite_pragma_pattern.match(sqlite_pragma.strip().lower())
+        if not match:
+            parser.error(f"--sqlite-pragma expects NAME=VALUE, got {sqlite_pragma}")
+        sqlite_pragma_overrides[match.group(1)] = match.group(2)
+    sqlite_pragmas.update(sqlite_pragma_overrides)
+    persistent_sqlite_pragmas.update(sqlite_pragma_overrides)
+    persistent_store = args.persistent
+    watch_interval = max(args.watch, 0)
+    server_host = args.host
+    server_port = args.port
+    server_workers = max(args.server_workers, 1)
+    bulk_load = not args.no_bulk_load
+    output_format = args.format
+    # Snapshots hold the matrix of the in-memory engine
+    engine = 'memory' if args.snapshot else args.engine
+    snapshot_path = args.snapshot
+    match_jobs = max(args.jobs, 1)
+    configure_query_cache(max(args.query_cache_size, 0))
+    input_directory = args.input_dir
+    output_directory = args.output_dir
+    use_parse_cache = args.cache
+    ingest_workers = args.workers if args.workers > 0 else os.cpu_count()
+    profiling = args.profile
+    cprofile_stage = args.cprofile
+    if cprofile_stage == 'read_file' and ingest_workers > 1:
+        # Worker processes cannot be profiled from here, so the Excel files are parsed in this process instead
+        print("--cprofile read_file parses the Excel files in this process, --workers is ignored")
+        ingest_workers = 1
+    if memory_budget and ingest_workers > 1:
+        # Worker processes hand back whole files, only the parser thread streams a file in batches
+        print("--memory-budget parses the Excel files in batches in this process, --workers is ignored")
+        ingest_workers = 1
+    return args
+
 def main():
+    args = parse_arguments()
+    if args.prune_cache:
+        prune_parse_cache()
+        return
+    if args.connect:
+        sys.exit(query_server(args.lookup, args.txt))
+    if args.lookup:
+        exit_code = 1
+        try:
+            exit_code = lookup_genes(args.lookup)
+        except KeyboardInterrupt:
+            print("Interrupted by user.")
+        finally:
+            clean_up()
+        sys.exit(exit_code)
+    if args.serve:
+        exit_code = 1
+        try:
+            exit_code = serve()
+        except KeyboardInterrupt:
+            print("Query server stopped by user.")
+            exit_code = 0
+        finally:
+            clean_up()
+        sys.exit(exit_code)
+    if args.batch:
+        exit_code = 1
+        try:
+            exit_code = batch_match(args.txt)
+        except KeyboardInterrupt:
+            print("Interrupted by user.")
+        finally:
+            clean_up()
+        sys.exit(exit_code)
     try:
         continue_with_automatch = initialization()
         # Keep the program running until the user decides to exit
         while True:
             if not continue_with_automatch:
-                user_input = input("[M]anual search\n[Q]uit\n Please make a selection:")
+                user_input = input("[M]anual search\n[C]ache statistics\n[Q]uit\n Please make a selection:")
             else:
-                user_input = input("[A]uto match and export output as an exel (.xlsx) file\n[M]anual search\n[Q]uit\n Please make a selection:")                
-
-                if user_input.lower() == 'q':   
-                    print("Exited by user")
-                    raise SystemExit
-                elif user_input.lower() == 'a' and continue_with_automatch:
-                    auto_match()
-                elif user_input.lower() == 'm':            
-                    manual_match()
-                else:
-                    print("Invalid selection, try again") 
+                user_input = input(f"[A]uto match and export output as {output_format_descriptions[output_format]}\n[M]anual search\n[C]ache statistics\n[Q]uit\n Please make a selection:")                
+
+            if user_input.lower() == 'q':   
+                print("Exited by user")
+                raise SystemExit
+            elif user_input.lower() == 'a' and continue_with_automatch:
+                auto_match()
+            elif user_input.lower() == 'm':            
+                manual_match()
+            elif user_input.lower() == 'c':
+                print_query_cache_statistics()
+            else:
+                print("Invalid selection, try again") 
     except KeyboardInterrupt:
         print("Interrupted by user.")            
     finally: